@@ -1,15 +1,53 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import requests
 import os
-import uuid
+import tempfile
+import time
 from pathlib import Path
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+from detection import DEFAULT_BACKEND, available_backends
+from downloads import convert_and_precompress, stl_download
+from jobs import JobQueue, QueueFull
 from key_processor import KeyProcessor
+from mesh_formats import DEFAULT_PRECISION, DEFAULT_PREVIEW_TRIANGLES, MESH_FORMATS, mesh_suffix, preview_path
+from license_client import KEYGEN_API_URL, LicenseServiceError, LicenseValidator
+from metrics import MetricsRegistry, sink_from_spec
+from result_cache import ResultCache, key_hasher
 
 app = FastAPI()
 
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Reject uploads by Content-Length before the multipart body is read
+    
+    Registered before CORS so the rejection still carries CORS headers.
+    """
+    content_length = request.headers.get("content-length")
+    # Allow some headroom for the multipart framing around the file
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + UPLOAD_FRAMING_BYTES:
+        return JSONResponse(status_code=413, content={"detail": f"Image exceeds {MAX_UPLOAD_BYTES} bytes"})
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Time every request, labelled by endpoint rather than raw path"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.scope.get("endpoint")
+    metrics.observe(
+        "keystl_http_request_seconds", time.perf_counter() - start,
+        endpoint=getattr(endpoint, "__name__", "unmatched"),
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
+
 # CORS middleware for frontend
 app.add_middleware(
     CORSMiddleware,
@@ -33,12 +71,54 @@ if not KEYGEN_ACCOUNT_ID or not KEYGEN_PRODUCT_TOKEN:
         "See README.md for setup instructions."
     )
 
+# Pooled, cached license validation (KEYGEN_API_URL can point at a local stand-in)
+license_validator = LicenseValidator(
+    KEYGEN_ACCOUNT_ID,
+    KEYGEN_PRODUCT_TOKEN,
+    base_url=os.getenv("KEYGEN_API_URL", KEYGEN_API_URL),
+    valid_ttl=float(os.getenv("LICENSE_CACHE_TTL", "300")),
+    invalid_ttl=float(os.getenv("LICENSE_NEGATIVE_TTL", "60")),
+)
+
 # Storage directories
 UPLOAD_DIR = Path("uploads")
 STL_DIR = Path("stl_files")
 UPLOAD_DIR.mkdir(exist_ok=True)
 STL_DIR.mkdir(exist_ok=True)
 
+# Uploads are parsed and written to disk as they arrive, and rejected past MAX_UPLOAD_BYTES
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 ** 2)))
+# Multipart framing and other form fields allowed on top of the file
+UPLOAD_FRAMING_BYTES = 64 * 1024
+
+# Content-addressed STL result cache in sharded directories, bounded by
+# total bytes on disk; entries unused for STORAGE_TTL seconds are swept
+STL_CACHE_MAX_BYTES = int(os.getenv("STL_CACHE_MAX_BYTES", str(1024 ** 3)))
+STORAGE_TTL = float(os.getenv("STORAGE_TTL", str(7 * 24 * 3600)))
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", "600"))
+result_cache = ResultCache(STL_DIR, UPLOAD_DIR, STL_CACHE_MAX_BYTES, ttl=STORAGE_TTL)
+
+# Most keys meshed from one photo when a conversion asks for every key
+MAX_KEYS_PER_IMAGE = int(os.getenv("MAX_KEYS_PER_IMAGE", "16"))
+
+# Grid in mm that vertices are snapped to in indexed formats such as 3MF
+MESH_PRECISION = float(os.getenv("MESH_PRECISION", str(DEFAULT_PRECISION)))
+
+# Triangle budget of the low-poly preview served at /api/preview (0 disables)
+PREVIEW_TRIANGLES = int(os.getenv("PREVIEW_TRIANGLES", str(DEFAULT_PREVIEW_TRIANGLES)))
+
+# Background conversion workers (JOB_WORKERS defaults to the CPU count)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "0")) or None
+JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", "32"))
+job_queue = JobQueue(max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_DEPTH)
+
+# Conversion and request metrics served at /metrics; METRICS_SINKS adds
+# comma-separated extra sinks for conversion records ("log", "json:<path>")
+metrics = MetricsRegistry()
+conversion_sinks = [metrics.record_conversion] + [
+    sink_from_spec(spec.strip()) for spec in os.getenv("METRICS_SINKS", "").split(",") if spec.strip()
+]
+
 class LicenseKey(BaseModel):
     key: str
 
@@ -47,93 +127,283 @@ def read_root():
     return {"message": "Key-to-STL API is running"}
 
 @app.post("/api/validate-license")
-def validate_license(license_data: LicenseKey):
+async def validate_license(license_data: LicenseKey):
     """Validate license key with Keygen API"""
-    url = f"https://api.keygen.sh/v1/accounts/{KEYGEN_ACCOUNT_ID}/licenses/actions/validate-key"
+    try:
+        return await license_validator.validate(license_data.key)
+    except LicenseServiceError as e:
+        # Keygen gave no answer about the key (outage or our own misconfiguration)
+        raise HTTPException(status_code=502, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+class UploadTooLarge(Exception):
+    pass
+
+class ConversionFailed(Exception):
+    """A conversion only produced the placeholder box"""
+
+class BadUpload(Exception):
+    pass
+
+async def _ingest_upload(request: Request, hasher, max_bytes: int):
+    """Stream the ``file`` field of a multipart request into UPLOAD_DIR, hashing it on the way
     
-    headers = {
-        "Authorization": f"Bearer {KEYGEN_PRODUCT_TOKEN}",
-        "Content-Type": "application/vnd.api+json",
-        "Accept": "application/vnd.api+json"
-    }
+    The body is parsed as it arrives from the client, never spooled first,
+    and parsing and disk writes run off the event loop. Returns the
+    temporary file path, its size and the client's file name. Raises
+    UploadTooLarge as soon as the file (or the whole body, which may only
+    add some headroom for the multipart framing) passes max_bytes, and
+    BadUpload if the request is not multipart or has no file field.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise BadUpload("Expected a multipart/form-data upload")
     
-    payload = {
-        "meta": {
-            "key": license_data.key
-        }
-    }
+    fd, tmp_name = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    out = os.fdopen(fd, "wb")
+    part = {}
+    found = {}
+    
+    def on_part_begin():
+        part.clear()
+        part.update(headers={}, field=b"", value=b"", file=False)
+    
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+    
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+    
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
     
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name") == b"file" and "size" not in found:
+            part["file"] = True
+            found.update(size=0, filename=disposition.get(b"filename", b"").decode("utf-8", "replace"))
+    
+    def on_part_data(data, start, end):
+        if not part["file"]:
+            return
+        chunk = data[start:end]
+        found["size"] += len(chunk)
+        if found["size"] > max_bytes:
+            raise UploadTooLarge()
+        hasher.update(chunk)
+        out.write(chunk)
+    
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+    })
+    received = 0
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        result = response.json()
-        
-        if response.status_code == 200 and result.get("meta", {}).get("valid"):
-            return {
-                "valid": True,
-                "license_id": result.get("data", {}).get("id"),
-                "message": "License validated successfully"
-            }
-        else:
-            return {
-                "valid": False,
-                "message": result.get("errors", [{}])[0].get("detail", "Invalid license key")
-            }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes + UPLOAD_FRAMING_BYTES:
+                raise UploadTooLarge()
+            if chunk:
+                await run_in_threadpool(parser.write, chunk)
+        parser.finalize()
+        out.close()
+        if "size" not in found:
+            raise BadUpload("Missing file field")
+    except BaseException:
+        out.close()
+        os.unlink(tmp_name)
+        raise
+    return Path(tmp_name), found["size"], found["filename"]
 
-@app.post("/api/generate-stl")
-async def generate_stl(file: UploadFile = File(...)):
-    """Generate STL from uploaded key image"""
-    # Save uploaded image
-    file_id = str(uuid.uuid4())
-    image_path = UPLOAD_DIR / f"{file_id}_{file.filename}"
-    
-    with open(image_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
-    
-    # TODO: Implement actual key-to-STL conversion
-    # For now, create a placeholder STL file
-    stl_filename = f"key_{file_id}.stl"
-    stl_path = STL_DIR / stl_filename
-    
-    # Placeholder STL content (simple triangle)
-    stl_content = """solid key
-  facet normal 0 0 1
-    outer loop
-      vertex 0 0 0
-      vertex 1 0 0
-      vertex 0.5 1 0
-    endloop
-  endfacet
-    with open(stl_path, "w") as f:
-    # Use KeyProcessor to generate actual STL
+def _stl_result(stl_paths):
+    """Download links for a result; the first file is also given at the top level"""
+    files = []
+    for path in stl_paths:
+        name = Path(path).name
+        file = {"downloadUrl": f"/api/download/{name}", "filename": name}
+        if preview_path(path).exists():
+            file["previewUrl"] = f"/api/preview/{name}"
+        files.append(file)
+    return {**files[0], "files": files}
+
+# The body is parsed by _ingest_upload, so describe it for the OpenAPI docs
+UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"],
+        }}},
+    },
+}
+
+@app.post("/api/generate-stl", status_code=202, openapi_extra=UPLOAD_BODY)
+async def generate_stl(request: Request, detector: str = Query(DEFAULT_BACKEND),
+                       multi: bool = Query(False), format: str = Query("stl")):
+    """Queue STL generation for an uploaded key image (multipart ``file`` field)
+    
+    With ``multi`` every key in the photo (a key ring or a tray of keys) is
+    converted from the one upload, each to its own STL listed in ``files``.
+    ``format=3mf`` writes compact indexed 3MF files instead of STL.
+    """
+    if detector not in available_backends():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown detector '{detector}', expected one of: {', '.join(available_backends())}",
+        )
+    if format not in MESH_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown format '{format}', expected one of: {', '.join(MESH_FORMATS)}",
+        )
+    processor = KeyProcessor()
+    processor.detector = detector
+    processor.output_format = format
+    processor.output_precision = MESH_PRECISION
+    processor.preview_triangles = PREVIEW_TRIANGLES
+    if multi:
+        processor.max_keys = MAX_KEYS_PER_IMAGE
+    
+    # Write the upload to disk as it arrives, hashing it as it goes
+    hasher = key_hasher(processor.params())
     try:
-        processor = KeyProcessor()
-        stl_filename = processor.generate_stl(str(image_path))
-        
-            "downloadUrl": f"/api/download/{stl_filename}",
-            "filename": stl_filename
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"STL generation failed: {str(e)}")    
-    return {
-        "downloadUrl": f"/api/download/{stl_filename}",
-        "filename": stl_filename
+        tmp_path, size, filename = await _ingest_upload(request, hasher, MAX_UPLOAD_BYTES)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail=f"Image exceeds {MAX_UPLOAD_BYTES} bytes")
+    except BadUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if size == 0:
+        tmp_path.unlink()
+        raise HTTPException(status_code=400, detail="Empty upload")
+    
+    # Return the existing STL if this image was already converted
+    cache_key = hasher.hexdigest()
+    entry = result_cache.get(cache_key)
+    if entry is not None:
+        tmp_path.unlink()
+        job_id = job_queue.completed(_stl_result(entry.stl_paths))
+        return {**job_queue.status(job_id), "statusUrl": f"/api/jobs/{job_id}"}
+    
+    image_path = result_cache.upload_path(cache_key, filename)
+    stl_path = result_cache.stl_path(cache_key, suffix=mesh_suffix(format))
+    os.replace(tmp_path, image_path)
+    
+    submitted = time.perf_counter()
+    
+    def finish(stats):
+        # Conversions run in worker processes, so their stats are recorded here
+        metrics.observe("keystl_job_seconds", time.perf_counter() - submitted)
+        record = {"image": str(image_path), **stats}
+        for sink in conversion_sinks:
+            sink(record)
+        if stats.get("fallback"):
+            # Never cache or serve the placeholder box; the job fails with the error
+            result_cache.discard(stats["outputs"], image_path)
+            raise ConversionFailed(f"Could not convert image: {stats['error']}")
+        result_cache.put(cache_key, stats["outputs"], image_path)
+        return _stl_result(stats["outputs"])
+    
+    # Convert in the background worker pool, gzipping the STL files there too
+    try:
+        job_id = job_queue.submit(
+            convert_and_precompress, processor, str(image_path), str(stl_path),
+            key=cache_key, finish=finish,
+        )
+    except QueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many conversions in progress, please retry shortly",
+            headers={"Retry-After": "5"},
+        )
+    
+    return {**job_queue.status(job_id), "statusUrl": f"/api/jobs/{job_id}"}
+
+@app.get("/api/jobs/{job_id}")
+def job_status(job_id: str):
+    """Report whether a conversion job is queued, running, done or failed"""
+    status = job_queue.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    """Report STL result cache hit/miss counters"""
+    return result_cache.stats()
+
+@app.get("/metrics")
+def metrics_endpoint(format: str = Query("prometheus")):
+    """Conversion latency histograms, fallback counts and cache/queue gauges"""
+    cache = result_cache.stats()
+    license_stats = license_validator.stats()
+    gauges = {
+        "keystl_cache_hits": cache["hits"],
+        "keystl_cache_misses": cache["misses"],
+        "keystl_cache_entries": cache["entries"],
+        "keystl_cache_bytes": cache["bytes"],
+        "keystl_jobs_pending": job_queue.stats()["pending"],
+        "keystl_license_cache_hits": license_stats["hits"],
+        "keystl_license_cache_misses": license_stats["misses"],
     }
+    if format == "json":
+        return {**metrics.to_dict(), "gauges": gauges}
+    return PlainTextResponse(metrics.render_prometheus(gauges), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+def start_storage_sweeper():
+    result_cache.start_sweeper(STORAGE_SWEEP_INTERVAL)
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    job_queue.shutdown()
+    result_cache.stop_sweeper()
+    await license_validator.aclose()
 
 @app.get("/api/download/{filename}")
-def download_stl(filename: str):
-    """Download generated STL file"""
-    file_path = STL_DIR / filename
+def download_stl(filename: str, request: Request):
+    """Download generated STL file
+    
+    Served gzipped when the client accepts it, with a strong ETag for
+    conditional requests and byte ranges for resuming.
+    """
+    # Answered from the in-memory index; unknown names never reach the disk
+    file_path = result_cache.lookup_stl(filename)
     
-    if not file_path.exists():
+    if file_path is None or not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(
-        path=file_path,
-        media_type="application/octet-stream",
-        filename=filename
+    response = stl_download(file_path, filename, request.headers)
+    _count_download(response, "mesh")
+    return response
+
+@app.get("/api/preview/{filename}")
+def download_preview(filename: str, request: Request):
+    """Low-poly preview of a generated mesh, for showing it in the browser
+    
+    ``filename`` is the mesh file's name. The preview format is described
+    in mesh_formats.py.
+    """
+    file_path = result_cache.lookup_stl(filename)
+    if file_path is None or not preview_path(file_path).exists():
+        raise HTTPException(status_code=404, detail="Preview not found")
+    
+    preview = preview_path(file_path)
+    response = stl_download(preview, preview.name, request.headers, attachment=False)
+    _count_download(response, "preview")
+    return response
+
+def _count_download(response, kind: str):
+    metrics.inc(
+        "keystl_download_bytes_total", int(response.headers.get("content-length", 0)),
+        kind=kind, encoding=response.headers.get("content-encoding", "identity"),
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Benchmark the image-to-STL pipelines on synthetic key images
+
+Generates key photos from 640px to 8K wide with a varying number of bitting
+cuts, runs them through KeyProcessor (lofted profile) and the
+test_conversion.py pipeline (extruded outline with holes), and writes the
+per-stage timings and peak memory of each run as JSON.
+
+Usage:
+    python benchmark.py -o results.json
+    python benchmark.py --sizes 640 1920 --cuts 20 --detectors canny otsu
+    python benchmark.py -o new.json --compare old.json
+
+Every case runs in a fresh process. On Linux its peak RSS is reset when it
+starts, so the figure is per case; ru_maxrss, used elsewhere, can carry
+over the parent's peak. Stage times are the median over --repeat runs
+after one warm-up run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from contours import simplify_contour
+from detection import available_backends, detect_key, timed
+from key_processor import KeyProcessor
+from mesh_builder import extrude_contour
+from stl_writer import write_binary_stl
+
+# Image widths from VGA to 8K, all 16:9
+SIZES = [640, 1280, 1920, 3840, 7680]
+# Bitting cuts per key, for simple to very detailed outlines
+CUTS = [5, 20, 80]
+PIPELINES = ["key_processor", "extrude"]
+
+# Matches test_conversion.py, which meshes in pixels
+EXTRUDE_TOLERANCE = 1.0
+EXTRUDE_THICKNESS = 3.0
+
+
+def synthetic_key(width, cuts, seed=0):
+    """Draw a dark key with ``cuts`` V-shaped cuts and a ring hole on a lit background
+
+    The background has a lighting gradient and sensor noise so detection
+    does real work. The same arguments always give the same image.
+    """
+    height = width * 9 // 16
+    rng = np.random.default_rng(seed + cuts)
+
+    # Unevenly lit paper background with noise
+    gradient = np.linspace(200, 235, width, dtype=np.float32)[None, :]
+    img = np.repeat(gradient, height, axis=0)
+    img += rng.normal(0, 4, (height, width)).astype(np.float32)
+
+    # Blade with cuts along its top edge, joined to the bow
+    bow_x = int(width * 0.20)
+    blade_left, blade_right = int(width * 0.30), int(width * 0.88)
+    blade_top, blade_bottom = int(height * 0.42), int(height * 0.58)
+    max_depth = (blade_bottom - blade_top) * 0.45
+    cut_xs = np.linspace(blade_left, blade_right, 2 * cuts + 1)
+    cut_ys = np.full(len(cut_xs), float(blade_top))
+    cut_ys[1::2] += rng.uniform(0.2, 1.0, cuts) * max_depth
+    outline = np.concatenate([
+        [[bow_x, blade_top]],
+        np.stack([cut_xs, cut_ys], axis=1),
+        [[blade_right + (blade_bottom - blade_top) * 0.5, (blade_top + blade_bottom) / 2],
+         [blade_right, blade_bottom], [bow_x, blade_bottom]],
+    ])
+    cv2.fillPoly(img, [np.round(outline).astype(np.int32)], 60)
+
+    # Round bow with a key-ring hole
+    centre = (bow_x, height // 2)
+    cv2.circle(img, centre, int(height * 0.16), 60, -1)
+    cv2.circle(img, centre, int(height * 0.045), 220, -1)
+
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def _run_key_processor(image_path, detector, out_dir):
+    processor = KeyProcessor()
+    processor.detector = detector
+    result = next(processor.generate_many([image_path], out_dir, workers=1))
+    if not result.ok:
+        raise ValueError(result.error)
+
+    # Expand detection into its own steps
+    stages = dict(result.stats["timings_ms"])
+    del stages["detect"], stages["total"]
+    detection = {k: v for k, v in result.stats["detection_ms"].items() if k != "total"}
+    stages = {"decode": stages.pop("decode"), **detection, **stages}
+    info = {key: result.stats[key] for key in ("contour_points", "triangles", "stl_bytes")}
+    return stages, info
+
+
+def _run_extrude(image_path, detector, out_dir):
+    """The test_conversion.py pipeline, timed step by step"""
+    timings = {}
+    with timed(timings, "decode"):
+        img = cv2.imread(str(image_path))
+    detection = detect_key(img, detector)
+    timings.update((k, v) for k, v in detection.timings.items() if k != "total")
+
+    with timed(timings, "holes"):
+        holes = detection.holes()
+    with timed(timings, "simplify"):
+        contour, _ = simplify_contour(detection.contour, EXTRUDE_TOLERANCE, 1.0)
+        holes = [simplify_contour(hole, EXTRUDE_TOLERANCE, 1.0)[0] for hole in holes]
+    with timed(timings, "mesh"):
+        vertices, faces = extrude_contour(
+            contour.reshape(-1, 2), EXTRUDE_THICKNESS,
+            holes=[hole.reshape(-1, 2) for hole in holes],
+        )
+    with timed(timings, "export"):
+        stl_bytes = write_binary_stl(Path(out_dir) / "extrude.stl", vertices, faces)
+
+    info = {"contour_points": len(detection.contour), "triangles": len(faces), "stl_bytes": stl_bytes}
+    return timings, info
+
+
+RUNNERS = {
+    "key_processor": _run_key_processor,
+    "extrude": _run_extrude,
+}
+
+
+def _proc_status_bytes(field):
+    """A memory figure from /proc/self/status (Linux only), or None"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Restart this process's peak RSS from its current RSS, where Linux allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    """Peak RSS of this process
+
+    VmHWM on Linux, which belongs to this process alone and can be reset.
+    Elsewhere ru_maxrss, which some systems carry over from the parent
+    across fork and exec, so it is only an upper bound there.
+    """
+    peak = _proc_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_case(image_path, pipeline, detector, repeat):
+    """Run one pipeline on one image (called in a fresh worker process)
+
+    The peak RSS count is reset once the worker has started, so
+    ``peak_rss_bytes`` covers this case only and ``baseline_rss_bytes`` is
+    the worker's RSS before it. ``peak_rss_exact`` is False where the peak
+    could not be reset and may include the parent's.
+    """
+    runner = RUNNERS[pipeline]
+    exact = _reset_peak_rss()
+    baseline_rss = _proc_status_bytes("VmRSS") if exact else _peak_rss_bytes()
+    with tempfile.TemporaryDirectory() as out_dir:
+        # Warm up caches and lazy initialisation before timing
+        runner(image_path, detector, out_dir)
+        runs = [runner(image_path, detector, out_dir) for _ in range(repeat)]
+
+    stages = {stage: statistics.median(run[0][stage] for run in runs) for stage in runs[0][0]}
+    totals = [sum(run[0].values()) for run in runs]
+    return {
+        "stages_ms": stages,
+        "total_ms": statistics.median(totals),
+        "min_total_ms": min(totals),
+        **runs[0][1],
+        "baseline_rss_bytes": baseline_rss,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "peak_rss_exact": exact,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, cuts, detectors, pipelines, repeat):
+    """Run every case and return the JSON-ready report"""
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+        },
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory() as image_dir:
+        for width in sizes:
+            for cut_count in cuts:
+                image = synthetic_key(width, cut_count)
+                image_path = str(Path(image_dir) / f"key_{width}_{cut_count}.jpg")
+                cv2.imwrite(image_path, image, [cv2.IMWRITE_JPEG_QUALITY, 92])
+                height = image.shape[0]
+                del image
+
+                for pipeline in pipelines:
+                    for detector in detectors:
+                        case = {
+                            "case": f"{width}x{height}-c{cut_count}",
+                            "width": width, "height": height, "cuts": cut_count,
+                            "pipeline": pipeline, "detector": detector,
+                        }
+                        # A fresh spawned process per case, whose peak RSS run_case resets
+                        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                            try:
+                                case.update(executor.submit(run_case, image_path, pipeline, detector, repeat).result())
+                            except Exception as e:
+                                case["error"] = str(e)
+                        report["results"].append(case)
+                        _print_case(case)
+    return report
+
+
+def _print_case(case):
+    label = f"{case['case']:>18} {case['pipeline']:>13} {case['detector']:>9}"
+    if "error" in case:
+        print(f"{label}  ERROR: {case['error']}")
+        return
+    stages = " ".join(f"{stage}={ms:.1f}" for stage, ms in case["stages_ms"].items())
+    print(f"{label} {case['total_ms']:9.1f} ms {case['peak_rss_bytes'] / 2 ** 20:7.0f} MiB  {stages}")
+
+
+def compare(report, baseline, tolerance):
+    """Print total time changes against a baseline report
+
+    Returns the number of cases more than ``tolerance`` slower.
+    """
+    def case_key(case):
+        return case["case"], case["pipeline"], case["detector"]
+
+    previous = {case_key(case): case for case in baseline["results"] if "error" not in case}
+    regressions = 0
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'}:")
+    for case in report["results"]:
+        old = previous.get(case_key(case))
+        if old is None or "error" in case:
+            continue
+        ratio = case["total_ms"] / old["total_ms"]
+        # Older reports (or other systems) may hold the parent's peak instead
+        memory = "n/a"
+        if case.get("peak_rss_exact") and old.get("peak_rss_exact"):
+            memory = f"{case['peak_rss_bytes'] / old['peak_rss_bytes']:4.2f}x"
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  SLOWER"
+            regressions += 1
+        print(f"{case['case']:>18} {case['pipeline']:>13} {case['detector']:>9} "
+              f"{old['total_ms']:9.1f} -> {case['total_ms']:9.1f} ms ({ratio:5.2f}x, memory {memory}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image-to-STL pipelines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="image widths in pixels")
+    parser.add_argument("--cuts", type=int, nargs="+", default=CUTS, help="bitting cuts per key")
+    parser.add_argument("--detectors", nargs="+", default=["canny"], choices=available_backends())
+    parser.add_argument("--pipelines", nargs="+", default=PIPELINES, choices=PIPELINES)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("-o", "--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="slowdown tolerated before --compare fails (default 0.10)")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.cuts, args.detectors, args.pipelines, args.repeat)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"\nWrote {args.output}")
+
+    failed = any("error" in case for case in report["results"])
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        failed |= compare(report, baseline, args.tolerance) > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Contour helpers shared by KeyProcessor and test_conversion.py"""
+
+import cv2
+import numpy as np
+
+# Contour edges intersected with the sample lines per step (bounds memory)
+EDGE_CHUNK = 4096
+
+
+def _children(hierarchy, index):
+    """Indices of the direct children of a contour in a RETR_TREE hierarchy"""
+    child = hierarchy[index][2]
+    while child != -1:
+        yield child
+        child = hierarchy[child][0]
+
+
+def find_key_holes(contours, hierarchy, key_index, depth=2, min_area_ratio=0.002):
+    """Find the holes (e.g. the key-ring hole) inside the key contour
+
+    ``hierarchy`` must come from ``cv2.findContours`` with ``RETR_TREE``.
+    On a Canny edge map every outline is traced twice, once on each side of
+    the edge, so a hole's outer boundary sits two levels below the key
+    (``depth=2``). On a filled binary mask holes are direct children
+    (``depth=1``). Holes smaller than ``min_area_ratio`` of the key area are
+    treated as noise and dropped.
+    """
+    if hierarchy is None:
+        return []
+    hierarchy = hierarchy.reshape(-1, 4)
+
+    level = [key_index]
+    for _ in range(depth):
+        level = [child for index in level for child in _children(hierarchy, index)]
+
+    min_area = cv2.contourArea(contours[key_index]) * min_area_ratio
+    return [contours[i] for i in level if cv2.contourArea(contours[i]) >= min_area]
+
+
+def simplify_contour(contour, tolerance_mm, scale):
+    """Simplify a contour to within ``tolerance_mm`` of the original outline
+
+    ``scale`` is the pixel-to-mm factor (mm per pixel). Douglas-Peucker
+    keeps points where the outline bends, such as bitting cuts, and drops
+    long runs of nearly collinear edge pixels. Returns the simplified
+    contour and the number of points removed.
+    """
+    if tolerance_mm <= 0 or len(contour) < 4:
+        return contour, 0
+    epsilon = tolerance_mm / scale
+    simplified = cv2.approxPolyDP(contour, epsilon, True)
+    if len(simplified) < 3:
+        return contour, 0
+    return simplified, len(contour) - len(simplified)
+
+
+def top_edge(contour, xs):
+    """Topmost y of a closed contour along each vertical line ``x`` in ``xs``
+
+    Every contour edge is intersected with every sample line at once (in
+    chunks of edges), so the profile is exact for simplified polygons too.
+    Lines that cross no edge get ``inf``.
+    """
+    points = np.asarray(contour, dtype=np.float64).reshape(-1, 2)
+    xs = np.asarray(xs, dtype=np.float64)
+    ends = np.roll(points, -1, axis=0)
+    top = np.full(len(xs), np.inf)
+
+    for start in range(0, len(points), EDGE_CHUNK):
+        x1, y1 = points[start:start + EDGE_CHUNK, :1], points[start:start + EDGE_CHUNK, 1:]
+        x2, y2 = ends[start:start + EDGE_CHUNK, :1], ends[start:start + EDGE_CHUNK, 1:]
+        lo, hi = np.minimum(x1, x2), np.maximum(x1, x2)
+
+        # Vertical edges never cross a vertical line; their end points belong to neighbours
+        crosses = (xs >= lo) & (xs <= hi) & (hi > lo)
+        dx = np.where(hi > lo, x2 - x1, 1.0)
+        y = np.where(crosses, y1 + (xs - x1) * (y2 - y1) / dx, np.inf)
+        np.minimum(top, y.min(axis=0), out=top)
+    return top
+
+
+def measure_bitting(contour, num_cuts=20, samples_per_cut=8, max_depth=None):
+    """Measure the bitting (cut depths) along the top edge of a key contour
+
+    The bounding rect is split into ``num_cuts`` equal-width cuts, each
+    sampled on ``samples_per_cut`` vertical lines. A cut's edge height is
+    the median of its samples. Depths are measured down from the highest
+    edge within ``max_depth`` of the deepest cut, so the taller bow does
+    not count as the blade's top, and are clipped to ``[0, max_depth]``.
+    All values are in contour (pixel) units and fully deterministic.
+
+    Returns ``(xs, depths)``: the centre x of each cut and its depth.
+    """
+    x, _, w, _ = cv2.boundingRect(np.asarray(contour, dtype=np.int32).reshape(-1, 1, 2))
+    samples = num_cuts * samples_per_cut
+    sample_xs = x + (np.arange(samples) + 0.5) * w / samples
+    top = top_edge(contour, sample_xs)
+
+    # Sample lines can only miss on degenerate contours; fill from neighbours
+    found = np.isfinite(top)
+    if not found.any():
+        return sample_xs[samples_per_cut // 2::samples_per_cut], np.zeros(num_cuts)
+    top[~found] = np.interp(sample_xs[~found], sample_xs[found], top[found])
+
+    cut_tops = np.median(top.reshape(num_cuts, samples_per_cut), axis=1)
+    cut_xs = x + (np.arange(num_cuts) + 0.5) * w / num_cuts
+
+    # Image y grows downwards, so deeper cuts have larger y
+    deepest = cut_tops.max()
+    if max_depth is None:
+        max_depth = deepest - cut_tops.min()
+    reference = cut_tops[cut_tops >= deepest - max_depth].min()
+    return cut_xs, np.clip(cut_tops - reference, 0, max_depth)
@@ -0,0 +1,324 @@
+"""Key outline detection backends
+
+Every backend turns a grayscale image into a binary map (edges or a filled
+mask) that the key outline is traced from, so they can be swapped per
+request and compared on speed and accuracy:
+
+- ``canny``: Gaussian blur and Canny edges, the original pipeline. Works on
+  most photos, and is the default.
+- ``otsu``: global Otsu threshold. Fastest, and ideal for scanner images
+  and photos on an evenly lit plain background.
+- ``adaptive``: local mean threshold. Copes with uneven lighting and
+  shadows across phone photos.
+- ``downscale``: runs another backend (``inner``) on a shrunken copy to
+  locate the key, then again at full resolution on just the region around
+  it. Cuts the cost of very large photos.
+
+``detect_key`` returns the largest outline in the image. ``detect_keys``
+returns every key-sized outline from the same segmentation pass, for photos
+of a key ring or a tray of keys.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+from contours import find_key_holes
+
+DEFAULT_BACKEND = "canny"
+
+# Outlines smaller than this fraction of the largest one are not keys
+MIN_KEY_AREA_RATIO = 0.2
+# Keys are at least this much longer than they are wide; rings and coins are not
+MIN_KEY_ELONGATION = 1.5
+
+
+class Detection(NamedTuple):
+    """Result of detecting the key in one image"""
+    contour: np.ndarray
+    contours: tuple
+    hierarchy: np.ndarray
+    key_index: int
+    hole_depth: int
+    backend: str
+    timings: dict
+
+    def holes(self, min_area_ratio=0.002):
+        """Holes inside the key outline, such as the key-ring hole"""
+        return find_key_holes(self.contours, self.hierarchy, self.key_index,
+                              depth=self.hole_depth, min_area_ratio=min_area_ratio)
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the wall time of the block to ``timings[stage]`` in milliseconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def _canny(gray, timings, low=50, high=150, blur=5):
+    """Canny edge map (each outline is traced on both sides of the edge)"""
+    with timed(timings, "blur"):
+        blurred = cv2.GaussianBlur(gray, (blur, blur), 0)
+    with timed(timings, "edges"):
+        return cv2.Canny(blurred, low, high), 2
+
+
+def _foreground_mask(binary):
+    """Make the key white on black, judging the background from the border"""
+    border = np.concatenate([binary[0], binary[-1], binary[:, 0], binary[:, -1]])
+    if np.count_nonzero(border) > border.size // 2:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def _otsu(gray, timings, blur=5):
+    """Filled mask from a global Otsu threshold"""
+    with timed(timings, "blur"):
+        blurred = cv2.GaussianBlur(gray, (blur, blur), 0)
+    with timed(timings, "threshold"):
+        _, binary = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return _foreground_mask(binary), 1
+
+
+def _adaptive(gray, timings, block_size=0, c=5, blur=5):
+    """Filled mask from a local mean threshold
+
+    Pixels more than ``c`` darker (or brighter, on a dark background) than
+    the mean of their ``block_size`` neighbourhood are foreground.
+    ``block_size`` defaults to a third of the shorter image side, so the
+    neighbourhood spans the key edge rather than just its texture.
+    """
+    if not block_size:
+        block_size = max(min(gray.shape) // 3, 3)
+    block_size |= 1
+    with timed(timings, "blur"):
+        blurred = cv2.GaussianBlur(gray, (blur, blur), 0)
+    with timed(timings, "threshold"):
+        border = np.concatenate([blurred[0], blurred[-1], blurred[:, 0], blurred[:, -1]])
+        if np.median(border) >= blurred.mean():
+            binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                           cv2.THRESH_BINARY_INV, block_size, c)
+        else:
+            binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                           cv2.THRESH_BINARY, block_size, -c)
+    # Close pinholes from texture and glare inside the key
+    with timed(timings, "morphology"):
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        return cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel), 1
+
+
+BACKENDS = {
+    "canny": _canny,
+    "otsu": _otsu,
+    "adaptive": _adaptive,
+}
+
+
+# Backends that fill the key's silhouette, which survives a reduced decode.
+# Canny traces edges, and on a downscaled key it locks onto the ring hole.
+MASK_BACKENDS = ("otsu", "adaptive")
+
+
+def available_backends():
+    """Names accepted by detect_key"""
+    return sorted([*BACKENDS, "downscale"])
+
+
+def _segment(gray, backend, options, timings, offset=(0, 0)):
+    """Run one segmentation backend and trace every outline"""
+    binary, hole_depth = BACKENDS[backend](gray, timings, **options)
+    with timed(timings, "contours"):
+        contours, hierarchy = cv2.findContours(binary, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+
+    if not contours:
+        raise ValueError("No key detected in image")
+    return contours, hierarchy, hole_depth
+
+
+def _largest(contours):
+    return max(range(len(contours)), key=lambda i: cv2.contourArea(contours[i]))
+
+
+def _trace(gray, backend, options, timings, offset=(0, 0)):
+    """Run one segmentation backend and trace the largest outline"""
+    contours, hierarchy, hole_depth = _segment(gray, backend, options, timings, offset)
+    return contours, hierarchy, _largest(contours), hole_depth
+
+
+def _key_indices(contours, hierarchy, max_keys, min_area_ratio, min_elongation):
+    """Indices of the key-sized outlines, largest first
+
+    An outline counts as a key if it is elongated, at least
+    ``min_area_ratio`` of the largest such outline, and not nested inside
+    another key (holes, and the inner side of Canny edges, are nested).
+    """
+    areas = [cv2.contourArea(contour) for contour in contours]
+    candidates = []
+    for i in sorted(range(len(contours)), key=areas.__getitem__, reverse=True):
+        (_, _), (w, h), _ = cv2.minAreaRect(contours[i])
+        if min(w, h) > 0 and max(w, h) / min(w, h) >= min_elongation:
+            candidates.append(i)
+    if not candidates:
+        raise ValueError("No key detected in image")
+
+    selected = set()
+    min_area = areas[candidates[0]] * min_area_ratio
+    for i in candidates:
+        if areas[i] < min_area or (max_keys and len(selected) >= max_keys):
+            break
+        # Larger outlines come first, so any enclosing key is already selected
+        parent = hierarchy[0][i][3]
+        while parent >= 0 and parent not in selected:
+            parent = hierarchy[0][parent][3]
+        if parent < 0:
+            selected.add(i)
+    return [i for i in candidates if i in selected]
+
+
+def _reading_order(rects):
+    """Order of bounding boxes in rows from top to bottom, each left to right
+
+    A box joins the current row if its centre lies within the vertical span
+    of the row's first box.
+    """
+    order = sorted(range(len(rects)), key=lambda i: rects[i][1] + rects[i][3] / 2)
+    rows = []
+    for i in order:
+        x, y, w, h = rects[i]
+        if rows:
+            _, top, _, height = rects[rows[-1][0]]
+            if top <= y + h / 2 <= top + height:
+                rows[-1].append(i)
+                continue
+        rows.append([i])
+    return [i for row in rows for i in sorted(row, key=lambda i: rects[i][0])]
+
+
+def _crop_around(rect, factor, margin, shape):
+    """Full-resolution bounds of a coarse-pass bounding box plus a margin"""
+    x, y, w, h = rect
+    height, width = shape
+    pad = int(max(w, h) * margin) + 2
+    x0 = max(int(x / factor) - pad, 0)
+    y0 = max(int(y / factor) - pad, 0)
+    x1 = min(int((x + w) / factor) + pad, width)
+    y1 = min(int((y + h) / factor) + pad, height)
+    return x0, y0, x1, y1
+
+
+def _shrink(gray, max_side, timings):
+    """Shrink for the coarse pass, returning the image and the scale factor"""
+    height, width = gray.shape
+    factor = max_side / max(height, width)
+    if factor >= 1:
+        return gray, 1.0
+    with timed(timings, "resize"):
+        small = cv2.resize(gray, (max(int(width * factor), 1), max(int(height * factor), 1)),
+                           interpolation=cv2.INTER_AREA)
+    return small, factor
+
+
+def _downscale_refine(gray, inner, max_side, margin, options, timings):
+    """Locate the key on a shrunken copy, then trace it at full size around that spot"""
+    small, factor = _shrink(gray, max_side, timings)
+    if factor == 1:
+        return _trace(gray, inner, options, timings)
+
+    # Coarse pass on the shrunken image
+    contours, _, key_index, _ = _trace(small, inner, options, timings)
+
+    # Full-resolution pass over the key's bounding box plus a margin
+    x0, y0, x1, y1 = _crop_around(cv2.boundingRect(contours[key_index]), factor, margin, gray.shape)
+    return _trace(gray[y0:y1, x0:x1], inner, options, timings, offset=(x0, y0))
+
+
+def _downscale_options(options):
+    inner = options.pop("inner", "otsu")
+    if inner not in BACKENDS:
+        raise ValueError(f"Unknown detection backend: {inner}")
+    return inner, options.pop("max_side", 1024), options.pop("margin", 0.05)
+
+
+def detect_key(img, backend: str = DEFAULT_BACKEND, **options) -> Detection:
+    """Detect the key outline in a decoded BGR or grayscale image
+
+    ``timings`` on the result holds milliseconds per step (``grayscale``,
+    ``blur``, ``edges`` or ``threshold``, ``contours``, ...) and ``total``.
+
+    ``options`` are passed to the backend, e.g. ``low``/``high`` for canny
+    or ``block_size``/``c`` for adaptive. The downscale backend also takes
+    ``inner`` (the backend to run, default ``otsu``), ``max_side`` (size of
+    the coarse pass, default 1024) and ``margin`` (fraction of the key size
+    added around it for the full-resolution pass, default 0.05).
+
+    Raises ValueError for an unknown backend or when no key is found.
+    """
+    timings = {}
+    with timed(timings, "grayscale"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    if backend == "downscale":
+        inner, max_side, margin = _downscale_options(options)
+        contours, hierarchy, key_index, hole_depth = _downscale_refine(
+            gray, inner, max_side, margin, options, timings)
+    elif backend in BACKENDS:
+        contours, hierarchy, key_index, hole_depth = _trace(gray, backend, options, timings)
+    else:
+        raise ValueError(f"Unknown detection backend: {backend}")
+
+    timings["total"] = sum(timings.values())
+    return Detection(contours[key_index], contours, hierarchy, key_index,
+                     hole_depth, backend, timings)
+
+
+def detect_keys(img, backend: str = DEFAULT_BACKEND, max_keys: int = 0,
+                min_area_ratio: float = MIN_KEY_AREA_RATIO,
+                min_elongation: float = MIN_KEY_ELONGATION, **options) -> list:
+    """Detect every key in a decoded image from one segmentation pass
+
+    Returns one Detection per key in reading order (rows from top to
+    bottom, each left to right), keeping the ``max_keys`` largest (0 for
+    no limit); they share the ``timings`` of the pass.
+    Outlines less than ``min_area_ratio`` of the largest key's area, or
+    less than ``min_elongation`` times longer than wide, are skipped.
+    Options and backends are as for detect_key; with ``downscale`` the
+    keys are located on the shrunken copy and each one is traced again at
+    full resolution.
+
+    Raises ValueError for an unknown backend or when no key is found.
+    """
+    timings = {}
+    with timed(timings, "grayscale"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    if backend == "downscale":
+        inner, max_side, margin = _downscale_options(options)
+        small, factor = _shrink(gray, max_side, timings)
+        contours, hierarchy, hole_depth = _segment(small, inner, options, timings)
+        indices = _key_indices(contours, hierarchy, max_keys, min_area_ratio, min_elongation)
+        if factor == 1:
+            traced = [(contours, hierarchy, i, hole_depth) for i in indices]
+        else:
+            traced = []
+            for i in indices:
+                x0, y0, x1, y1 = _crop_around(cv2.boundingRect(contours[i]), factor, margin, gray.shape)
+                traced.append(_trace(gray[y0:y1, x0:x1], inner, options, timings, offset=(x0, y0)))
+    elif backend in BACKENDS:
+        contours, hierarchy, hole_depth = _segment(gray, backend, options, timings)
+        indices = _key_indices(contours, hierarchy, max_keys, min_area_ratio, min_elongation)
+        traced = [(contours, hierarchy, i, hole_depth) for i in indices]
+    else:
+        raise ValueError(f"Unknown detection backend: {backend}")
+
+    rects = [cv2.boundingRect(contours[key_index]) for contours, _, key_index, _ in traced]
+    traced = [traced[i] for i in _reading_order(rects)]
+    timings["total"] = sum(timings.values())
+    return [Detection(contours[key_index], contours, hierarchy, key_index, hole_depth, backend, timings)
+            for contours, hierarchy, key_index, hole_depth in traced]
@@ -0,0 +1,234 @@
+"""Precompressed, conditional and ranged STL downloads
+
+Each STL gets a gzip copy next to it (``key_<key>.stl.gz``) when it is
+generated, in the conversion worker, so downloads never compress on the
+fly. Clients that accept gzip get the smaller copy. Both variants carry a
+strong ETag, answer ``If-None-Match`` with ``304`` and serve single byte
+ranges (``206``) so interrupted downloads can resume.
+
+STL file names are content addressed (the hash of the image and the
+processor parameters), but an evicted entry regenerated by newer pipeline
+code reuses the name, often with the same size. The ETag is therefore the
+name plus a digest of the bytes served, memoised per file size and
+modification time so repeat requests only stat the file.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from starlette.responses import Response, StreamingResponse
+
+from mesh_formats import preview_path
+from result_cache import gzip_path
+
+CHUNK_SIZE = 64 * 1024
+
+# Names are content addressed, so a day before revalidating is safe
+CACHE_CONTROL = "public, max-age=86400"
+
+# Content types by mesh file suffix
+MEDIA_TYPES = {
+    ".stl": "application/octet-stream",
+    ".3mf": "model/3mf",
+}
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested byte range starts past the end of the file"""
+
+
+def precompress(path, level: int = 9) -> int:
+    """Write a gzip copy next to an STL file, returning its size
+
+    The copy is only kept if it is smaller than the file (0 is returned
+    otherwise). The gzip header has no name or timestamp, so the same STL
+    always gives the same bytes.
+    """
+    target = gzip_path(path)
+    part = target.with_name(target.name + ".part")
+    with open(path, "rb") as src, open(part, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=level, mtime=0) as out:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+    size = part.stat().st_size
+    if size >= Path(path).stat().st_size:
+        part.unlink()
+        return 0
+    os.replace(part, target)
+    return size
+
+
+def convert_and_precompress(processor, image_path: str, output_path: str) -> dict:
+    """Run processor.convert and gzip every STL and preview it wrote (for the job pool)"""
+    stats = processor.convert(image_path, output_path)
+    written = [path for output in stats["outputs"] for path in (Path(output), preview_path(output))]
+    stats["gzip_bytes"] = sum(precompress(path) for path in written if path.exists())
+    return stats
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Whether an Accept-Encoding header allows a gzip response"""
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+    for coding in ("gzip", "x-gzip"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return qualities.get("*", 0) > 0
+
+
+@lru_cache(maxsize=4096)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    # size and mtime_ns only key the memo, so a rewritten file is hashed again
+    digest = hashlib.blake2b(digest_size=12)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_etag(filename: str, digest: str, encoding: Optional[str] = None) -> str:
+    """Strong ETag for one representation of a stored STL file"""
+    stem = filename.rsplit(".", 1)[0]
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{stem}-{digest}{suffix}"'
+
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    """Whether an If-None-Match or If-Range header matches ``etag``
+
+    ``weak`` comparison (for If-None-Match) ignores the ``W/`` prefix;
+    strong comparison (for If-Range) never matches a weak tag.
+    """
+    if not header:
+        return False
+    if weak and header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def parse_range(header: Optional[str], size: int):
+    """Byte range (first, last) requested by a Range header, or None
+
+    Anything but a single well-formed byte range is ignored, so the whole
+    file is served. Raises RangeNotSatisfiable if the range lies wholly
+    past the end of the file.
+    """
+    if not header:
+        return None
+    match = RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def _file_chunks(path: Path, first: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(first)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def stl_download(path: Path, filename: str, headers, attachment: bool = True) -> Response:
+    """Response for downloading a stored STL file (or its preview, with ``attachment`` off)
+
+    Picks the gzip copy when the request's ``Accept-Encoding`` allows it,
+    then answers ``If-None-Match`` with 304, a satisfiable ``Range`` (and
+    matching ``If-Range``) with 206 and a range past the end with 416.
+    """
+    encoding = None
+    source = path
+    compressed = gzip_path(path)
+    if accepts_gzip(headers.get("accept-encoding")) and compressed.exists():
+        encoding = "gzip"
+        source = compressed
+    stat = source.stat()
+    size = stat.st_size
+    etag = make_etag(filename, _file_digest(str(source), size, stat.st_mtime_ns), encoding)
+
+    response_headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if etag_matches(headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    if attachment:
+        response_headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    if encoding:
+        response_headers["Content-Encoding"] = encoding
+
+    # A range only applies to the representation the client already has part of
+    byte_range = None
+    if_range = headers.get("if-range")
+    if if_range is None or etag_matches(if_range, etag, weak=False):
+        try:
+            byte_range = parse_range(headers.get("range"), size)
+        except RangeNotSatisfiable:
+            response_headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=response_headers)
+
+    status = 200
+    first, last = 0, size - 1
+    if byte_range is not None:
+        status = 206
+        first, last = byte_range
+        response_headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    length = last - first + 1
+    response_headers["Content-Length"] = str(length)
+
+    return StreamingResponse(
+        _file_chunks(source, first, length),
+        status_code=status,
+        media_type=MEDIA_TYPES.get(path.suffix, "application/octet-stream"),
+        headers=response_headers,
+    )
@@ -0,0 +1,181 @@
+"""Background job queue for STL generation
+
+Conversions run in a bounded process pool so CPU-heavy OpenCV and mesh work
+never blocks the API event loop. Clients get a job id straight away and poll
+its status until it is done or failed.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+WORKER_CRASHED = "Conversion worker crashed (the image may be too large)"
+
+
+class QueueFull(Exception):
+    """Raised when the queue already holds the maximum number of pending jobs"""
+
+
+class Job:
+    """State of one submitted conversion"""
+
+    def __init__(self, job_id: str, key: Optional[str] = None):
+        self.id = job_id
+        self.key = key
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    def to_dict(self):
+        status = self.status
+        if status == QUEUED and self.future is not None and self.future.running():
+            status = RUNNING
+        data = {"jobId": self.id, "status": status}
+        if self.result is not None:
+            data.update(self.result)
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobQueue:
+    """Bounded worker pool with pollable job status
+
+    ``max_workers`` conversions run at once and at most ``max_pending`` jobs
+    (running plus queued) are accepted before ``submit`` raises QueueFull.
+    Finished jobs are kept for polling, up to ``history`` of them.
+
+    If a worker process dies (e.g. killed for running out of memory) the
+    pool is broken: its in-flight jobs fail and a new pool is started.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, max_pending: int = 32,
+                 history: int = 1000, executor=None):
+        self.max_pending = max_pending
+        self.history = history
+        self.max_workers = max_workers
+        self._executor = executor or ProcessPoolExecutor(max_workers=max_workers)
+        self._jobs = OrderedDict()
+        self._pending_by_key = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, key: Optional[str] = None,
+               finish: Optional[Callable] = None) -> str:
+        """Queue ``fn(*args)`` and return its job id
+
+        ``finish`` runs in this process with the return value of ``fn`` and
+        returns the dict reported to clients once the job is done. Jobs
+        submitted with the same ``key`` while one is still pending share it.
+        """
+        with self._lock:
+            if key is not None and key in self._pending_by_key:
+                return self._pending_by_key[key]
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} jobs already pending")
+
+            job = Job(uuid.uuid4().hex, key)
+            self._jobs[job.id] = job
+            self._pending += 1
+            if key is not None:
+                self._pending_by_key[key] = job.id
+            executor = self._executor
+
+        try:
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                executor = self._replace_executor(executor)
+                future = executor.submit(fn, *args)
+        except Exception:
+            # Never leave a pending slot or a key attached to a job that never ran
+            with self._lock:
+                self._release(job)
+                del self._jobs[job.id]
+            raise
+
+        job.future = future
+        future.add_done_callback(lambda future: self._finish(job, future, finish, executor))
+        return job.id
+
+    def _replace_executor(self, broken):
+        """Start a new worker pool in place of a broken one (once, however many jobs notice)"""
+        with self._lock:
+            if self._executor is broken:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            executor = self._executor
+        broken.shutdown(wait=False, cancel_futures=True)
+        return executor
+
+    def completed(self, result: dict) -> str:
+        """Record a job that finished without queueing, e.g. a cache hit"""
+        job = Job(uuid.uuid4().hex)
+        job.status = DONE
+        job.result = result
+        job.finished_at = job.created_at
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        return job.id
+
+    def _finish(self, job: Job, future, finish: Optional[Callable], executor):
+        try:
+            value = future.result()
+            job.result = finish(value) if finish else {}
+            job.status = DONE
+        except BrokenProcessPool:
+            job.error = WORKER_CRASHED
+            job.status = FAILED
+            self._replace_executor(executor)
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        job.finished_at = time.time()
+
+        with self._lock:
+            self._release(job)
+            self._trim()
+
+    def _release(self, job: Job):
+        """Free a job's pending slot and key (with the lock held)"""
+        self._pending -= 1
+        if job.key is not None and self._pending_by_key.get(job.key) == job.id:
+            del self._pending_by_key[job.key]
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history limit"""
+        excess = len(self._jobs) - self._pending - self.history
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].status in (DONE, FAILED):
+                del self._jobs[job_id]
+                excess -= 1
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """Client-facing status of a job, or None if unknown"""
+        job = self._jobs.get(job_id)
+        return job.to_dict() if job else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "tracked": len(self._jobs),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,8 +1,51 @@
+import logging
 import cv2
 import numpy as np
-import trimesh
 from PIL import Image
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple, Optional
+from contours import measure_bitting, simplify_contour
+from detection import DEFAULT_BACKEND, MASK_BACKENDS, detect_key, detect_keys, timed
+from mesh_builder import box, loft_profile
+from mesh_formats import DEFAULT_PRECISION, decimate, mesh_suffix, preview_path, write_mesh, write_preview
+
+logger = logging.getLogger(__name__)
+
+# cv2.imdecode flags for each supported scale-down factor
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# How far the detected key width may stray from the probe's before a reduced
+# decode is redone at full size (the 1/8 probe is only accurate to ~8 px)
+PROBE_WIDTH_TOLERANCE = 0.15
+
+
+def key_output_path(output_path, index: int) -> str:
+    """Output file for the ``index``-th key of an image (``key.stl``, ``key_1.stl``, ...)"""
+    if index == 0:
+        return str(output_path)
+    path = Path(output_path)
+    return str(path.with_name(f"{path.stem}_{index}{path.suffix}"))
+
+
+class ConversionResult(NamedTuple):
+    """Outcome of converting one image in a batch"""
+    image_path: str
+    output_path: str
+    error: Optional[str] = None
+    stats: Optional[dict] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
 
 class KeyProcessor:
     """Process key images and generate 3D STL models"""
@@ -13,110 +56,406 @@ class KeyProcessor:
         self.key_width = 10.0
         self.key_thickness = 2.0
         self.bitting_depth = 2.5
+        
+        # Bitting measurement: number of cuts and edge samples per cut
+        self.bitting_cuts = 20
+        self.bitting_samples = 8
+        
+        # Contour simplification tolerance (in mm, 0 disables)
+        self.simplify_tolerance = 0.05
+        
+        # Coarsest decoded pixel allowed (in mm of key, 0 always decodes at full size)
+        self.pixel_tolerance = 0.05
+        
+        # Key detection backend (see detection.py) and its options
+        self.detector = DEFAULT_BACKEND
+        self.detector_options = {}
+        
+        # Keys to mesh per image; above 1, every key found is written to its
+        # own STL (see key_output_path)
+        self.max_keys = 1
+        
+        # Output file format ("stl" or the indexed "3mf", see mesh_formats.py)
+        # and the grid indexed formats snap vertices to (in mm)
+        self.output_format = "stl"
+        self.output_precision = DEFAULT_PRECISION
+        
+        # Triangle budget of the low-poly web preview written next to each
+        # mesh (see mesh_formats.preview_path), 0 for no preview
+        self.preview_triangles = 0
+        
+        # Stats from the most recent generate_stl call
+        self.last_stats = {}
+        
+        # Optional callable receiving one stats record per conversion (see metrics.py)
+        self.metrics_sink = None
     
-    def detect_key_contour(self, image_path: str):
-        """Detect key outline from image"""
-        # Load image
-        img = cv2.imread(image_path)
+    def params(self):
+        """Parameters that affect the generated STL (used for result caching)"""
+        return {
+            "key_length": self.key_length,
+            "key_width": self.key_width,
+            "key_thickness": self.key_thickness,
+            "bitting_depth": self.bitting_depth,
+            "bitting_cuts": self.bitting_cuts,
+            "bitting_samples": self.bitting_samples,
+            "simplify_tolerance": self.simplify_tolerance,
+            "pixel_tolerance": self.pixel_tolerance,
+            "detector": self.detector,
+            "detector_options": self.detector_options,
+            "max_keys": self.max_keys,
+            "output_format": self.output_format,
+            "output_precision": self.output_precision,
+            "preview_triangles": self.preview_triangles,
+        }
+    
+    def _read_buffer(self, source):
+        """Encoded image bytes from a file path (memory-mapped) or a buffer"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return np.frombuffer(source, dtype=np.uint8)
+        try:
+            return np.memmap(str(source), dtype=np.uint8, mode="r")
+        except (OSError, ValueError):
+            raise ValueError("Could not load image")
+    
+    def load_image(self, source, reduction: int = 1):
+        """Decode a key image from a file path or an in-memory buffer
+        
+        Files are memory-mapped and decoded in place rather than read into
+        a separate buffer first. ``reduction`` (1, 2, 4 or 8) decodes at
+        that fraction of the full size; JPEGs are scaled inside the decoder
+        (DCT scaling), so the full-size image is never allocated.
+        """
+        if isinstance(source, np.ndarray):
+            buffer = source
+        else:
+            buffer = self._read_buffer(source)
+        img = cv2.imdecode(buffer, REDUCED_DECODE_FLAGS[reduction])
         if img is None:
             raise ValueError("Could not load image")
+        return img
+    
+    def decode_reduction(self, buffer):
+        """Largest decode scale-down that keeps pixels within pixel_tolerance
         
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        Measures the key on a 1/8 size probe decode, then picks the largest
+        factor at which one pixel still spans at most pixel_tolerance mm of
+        the key_length. The probe always uses the Otsu mask, which finds
+        the key's extent reliably even at this size. Returns the factor and
+        the key width in full-resolution pixels (None when not probed).
         
-        # Apply Gaussian blur
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        Only JPEGs are probed: they are scaled inside the decoder, so the
+        probe is cheap, while other formats would be decoded in full twice.
+        Detectors that need full-size pixels (see reduces_decode) are never
+        probed. Falls back to 1 if the probe finds no key.
+        """
+        if (self.pixel_tolerance <= 0 or not self.reduces_decode()
+                or bytes(buffer[:3]) != JPEG_MAGIC):
+            return 1, None
+        probe = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if probe is None:
+            raise ValueError("Could not load image")
+        try:
+            if self.max_keys > 1:
+                # The smallest key sets the resolution
+                probe_width = min(cv2.boundingRect(detection.contour)[2]
+                                  for detection in detect_keys(probe, "otsu", max_keys=self.max_keys))
+            else:
+                _, _, probe_width, _ = cv2.boundingRect(detect_key(probe, "otsu").contour)
+        except ValueError:
+            return 1, None
+        
+        # Key width in full-resolution pixels
+        key_pixels = probe_width * 8
+        for reduction in (8, 4, 2):
+            if reduction * self.key_length / key_pixels <= self.pixel_tolerance:
+                return reduction, key_pixels
+        return 1, key_pixels
+    
+    def reduces_decode(self):
+        """Whether the configured detector works on a reduced decode
         
-        # Edge detection
-        edges = cv2.Canny(blurred, 50, 150)
+        Only mask backends (directly or inside downscale) find the key
+        reliably at 1/2 size or less; canny is always given full size.
+        """
+        backend = self.detector
+        if backend == "downscale":
+            backend = self.detector_options.get("inner", "otsu")
+        return backend in MASK_BACKENDS
+    
+    def decode(self, source):
+        """Decode a key image at the smallest size that keeps pixel_tolerance
         
-        # Find contours
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        Returns the image and the reduction factor it was decoded at, so
+        peak memory depends on the key size and tolerance rather than on
+        the camera's resolution.
+        """
+        buffer = self._read_buffer(source)
+        reduction, _ = self.decode_reduction(buffer)
+        return self.load_image(buffer, reduction), reduction
+    
+    def decode_and_detect(self, source, timings: Optional[dict] = None):
+        """Decode a key image and detect its keys with the configured backend
         
-        if not contours:
-            raise ValueError("No key detected in image")
+        The reduced decode is chosen from an Otsu probe. As a safeguard, if
+        the smallest key the configured detector finds is not about as wide
+        as the probe measured, the image is decoded and detected again at
+        full size. Returns the image, the reduction it
+        was decoded at and the list of Detections.
+        """
+        if timings is None:
+            timings = {}
+        with timed(timings, "decode"):
+            buffer = self._read_buffer(source)
+            reduction, key_pixels = self.decode_reduction(buffer)
+            img = self.load_image(buffer, reduction)
+        with timed(timings, "detect"):
+            detections = self.detect_all(img)
+        if reduction == 1:
+            return img, reduction, detections
         
-        # Get largest contour (assumed to be the key)
-        key_contour = max(contours, key=cv2.contourArea)
+        width = min(cv2.boundingRect(detection.contour)[2] for detection in detections)
+        if abs(width * reduction - key_pixels) <= PROBE_WIDTH_TOLERANCE * key_pixels:
+            return img, reduction, detections
+        logger.info("Detected key width %d px at 1/%d does not match the probe (%d px), decoding at full size",
+                    width * reduction, reduction, key_pixels)
+        with timed(timings, "decode"):
+            img = self.load_image(buffer)
+        with timed(timings, "detect"):
+            detections = self.detect_all(img)
+        return img, 1, detections
+    
+    def detect_key_contour(self, image_path: str):
+        """Detect key outline from image
         
-        return key_contour, img.shape
+        Contour and shape are in decoded pixels (see decode_and_detect).
+        """
+        img, _, detections = self.decode_and_detect(image_path)
+        return detections[0].contour, img.shape
+    
+    def find_key_contour(self, img):
+        """Detect key outline in an already decoded image"""
+        return self.detect(img).contour
+    
+    def detect(self, img):
+        """Run the configured detection backend, returning a Detection"""
+        return detect_key(img, self.detector, **self.detector_options)
+    
+    def detect_all(self, img):
+        """Detect up to max_keys keys in one pass, returning a list of Detections"""
+        if self.max_keys <= 1:
+            return [self.detect(img)]
+        return detect_keys(img, self.detector, max_keys=self.max_keys, **self.detector_options)
     
     def extract_bitting_profile(self, image_path: str):
         """Extract key bitting (teeth) profile"""
         contour, shape = self.detect_key_contour(image_path)
+        return self.bitting_profile_from_contour(contour)
+    
+    def bitting_profile_from_contour(self, contour):
+        """Extract key bitting (teeth) profile from a detected contour
         
-        # Simplified bitting extraction
-        # In production, this would use more sophisticated detection
-        x, y, w, h = cv2.boundingRect(contour)
-        
-        # Sample points along the key edge
-        num_points = 20
-        bitting_points = []
+        Returns (x_pixel, depth_mm) pairs at the centre of each cut and the
+        contour's bounding size in pixels.
+        """
+        _, _, w, h = cv2.boundingRect(contour)
         
-        for i in range(num_points):
-            x_pos = x + (i * w // num_points)
-            # Simplified: vary depth randomly for demo
-            depth = np.random.uniform(0, self.bitting_depth)
-            bitting_points.append((x_pos, depth))
+        # Measure cut depths along the top edge, in pixels, then convert to mm
+        scale = self.key_length / w
+        xs, depths = measure_bitting(
+            contour, self.bitting_cuts, self.bitting_samples, self.bitting_depth / scale
+        )
+        bitting_points = list(zip(xs.tolist(), (depths * scale).tolist()))
         
         return bitting_points, (w, h)
     
     def generate_stl(self, image_path: str, output_path: str):
         """Generate STL file from key image"""
+        self.convert(image_path, output_path)
+        return True
+    
+    def convert(self, image_path: str, output_path: str):
+        """Generate STL file from key image and return its stats
+        
+        With max_keys above 1 every key in the image gets its own file,
+        listed in the stats under ``outputs``. Falls back to a placeholder
+        box if the key cannot be converted, in which case the stats have
+        ``fallback`` set and the ``error``.
+        """
+        timings = {}
         try:
-            # Extract key profile
-            bitting_points, (width, height) = self.extract_bitting_profile(image_path)
-            
-            # Create 3D mesh
-            vertices = []
-            faces = []
-            
-            # Scale factor (pixels to mm)
-            scale = self.key_length / width
-            
-            # Generate vertices for key blank with bitting
-            for i, (x, depth) in enumerate(bitting_points):
-                x_scaled = (x * scale) - (self.key_length / 2)
-                
-                # Front face vertices
-                vertices.extend([
-                    [x_scaled, -self.key_width/2, 0],
-                    [x_scaled, self.key_width/2, 0],
-                    [x_scaled, -self.key_width/2, self.key_thickness - depth],
-                    [x_scaled, self.key_width/2, self.key_thickness - depth]
-                ])
-            
-            # Create faces connecting vertices
-            for i in range(len(bitting_points) - 1):
-                base = i * 4
-                # Bottom face
-                faces.append([base, base + 4, base + 1])
-                faces.append([base + 1, base + 4, base + 5])
-                # Top face
-                faces.append([base + 2, base + 3, base + 6])
-                faces.append([base + 3, base + 7, base + 6])
-                # Side faces
-                faces.append([base, base + 2, base + 4])
-                faces.append([base + 4, base + 2, base + 6])
-                faces.append([base + 1, base + 5, base + 3])
-                faces.append([base + 3, base + 5, base + 7])
-            
-            # Create mesh
-            mesh = trimesh.Trimesh(vertices=np.array(vertices), faces=np.array(faces))
-            
-            # Export to STL
-            mesh.export(output_path)
-            
-            return True
-            
+            stats = self._build_stl(image_path, output_path, timings)
         except Exception as e:
-            print(f"Error generating STL: {str(e)}")
+            logger.exception("Could not convert %s, writing placeholder box", image_path)
             # Fallback to simple placeholder
-            self._create_simple_key_stl(output_path)
-            return True
+            stl_bytes = self._create_simple_key_stl(output_path)
+            timings["total"] = sum(timings.values())
+            stats = {
+                "fallback": True,
+                "error": str(e),
+                "detector": self.detector,
+                "format": self.output_format,
+                "vertices": 8,
+                "triangles": 12,
+                "stl_bytes": stl_bytes,
+                "outputs": [str(output_path)],
+                "timings_ms": timings,
+            }
+        
+        self.last_stats = stats
+        self._emit(image_path, stats)
+        return stats
+    
+    def _emit(self, image_path: str, stats: dict):
+        """Send a conversion record to the metrics sink, if any"""
+        if self.metrics_sink is None:
+            return
+        try:
+            self.metrics_sink({"image": str(image_path), **stats})
+        except Exception:
+            logger.exception("Metrics sink failed")
+    
+    def generate_many(self, image_paths, out_dir, workers: Optional[int] = None):
+        """Convert many key images in a process pool, yielding results as they finish
+        
+        Unlike generate_stl, failures are reported per item through
+        ConversionResult.error instead of falling back to the placeholder box.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Pair each image with its output file, keeping names unique
+        jobs = []
+        used_names = set()
+        extension = mesh_suffix(self.output_format)
+        for image_path in image_paths:
+            stem = Path(image_path).stem
+            name = f"{stem}_key{extension}"
+            suffix = 1
+            while name in used_names:
+                name = f"{stem}_{suffix}_key{extension}"
+                suffix += 1
+            used_names.add(name)
+            jobs.append((str(image_path), str(out_dir / name)))
+        
+        if workers == 1:
+            for image_path, output_path in jobs:
+                yield self._convert_one(image_path, output_path)
+            return
+        
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            futures = [executor.submit(self._convert_one, image_path, output_path)
+                       for image_path, output_path in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Drop pending work if the caller stops consuming early
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def _convert_one(self, image_path: str, output_path: str):
+        """Convert a single image for generate_many, capturing any failure"""
+        try:
+            stats = self._build_stl(image_path, output_path)
+            self._emit(image_path, stats)
+            return ConversionResult(image_path, output_path, stats=stats)
+        except Exception as e:
+            self._emit(image_path, {"error": str(e), "detector": self.detector})
+            return ConversionResult(image_path, output_path, str(e))
+    
+    def simplify_contour(self, contour, scale: float):
+        """Simplify a detected contour to the configured tolerance"""
+        return simplify_contour(contour, self.simplify_tolerance, scale)
+    
+    def _build_stl(self, image_path: str, output_path: str, timings: Optional[dict] = None):
+        """Generate STL files from key image, raising on failure
+        
+        Returns a dict of pipeline stats for the conversion, including the
+        milliseconds spent in each stage under ``timings_ms`` (also filled
+        into ``timings`` if given, so they survive a failure). Mesh sizes
+        are totals over all keys; ``keys`` has the stats of each file.
+        """
+        if timings is None:
+            timings = {}
+        
+        # Decode the image and detect the key outlines (again at full size
+        # only if the reduced decode misled the detector)
+        _, reduction, detections = self.decode_and_detect(image_path, timings)
+        
+        # Mesh each key; stage timings add up over the keys
+        keys = [
+            self._build_key(detection.contour, key_output_path(output_path, index), timings)
+            for index, detection in enumerate(detections)
+        ]
+        timings["total"] = sum(timings.values())
+        
+        return {
+            "decode_reduction": reduction,
+            **{name: sum(key[name] for key in keys)
+               for name in ("contour_points", "points_removed", "vertices", "triangles", "stl_bytes",
+                            "preview_bytes")},
+            "detector": detections[0].backend,
+            "format": self.output_format,
+            "detection_ms": detections[0].timings,
+            "outputs": [key["output"] for key in keys],
+            "keys": keys,
+            "timings_ms": timings,
+        }
+    
+    def _build_key(self, contour, output_path: str, timings: dict):
+        """Mesh one detected key outline and write it to output_path"""
+        # Scale factor (pixels to mm)
+        left, _, width, _ = cv2.boundingRect(contour)
+        scale = self.key_length / width
+        
+        # Drop nearly collinear edge points before meshing
+        with timed(timings, "simplify"):
+            simplified, removed = self.simplify_contour(contour, scale)
+        
+        # Extract key profile
+        with timed(timings, "bitting"):
+            bitting_points, _ = self.bitting_profile_from_contour(simplified)
+        
+        # Generate key blank with bitting as a lofted cross-section
+        with timed(timings, "mesh"):
+            xs = np.array([x for x, _ in bitting_points], dtype=np.float64)
+            depths = np.array([depth for _, depth in bitting_points], dtype=np.float64)
+            vertices, faces = loft_profile(
+                (xs - left) * scale - self.key_length / 2,
+                self.key_thickness - depths,
+                self.key_width / 2,
+            )
+        
+        # Export to the output format
+        with timed(timings, "export"):
+            stl_bytes = write_mesh(output_path, vertices, faces, self.output_format, self.output_precision)
+        
+        # Low-poly copy for web previews
+        preview_bytes = 0
+        if self.preview_triangles:
+            with timed(timings, "preview"):
+                preview_bytes = self._write_preview(output_path, vertices, faces)
+        
+        return {
+            "output": output_path,
+            "contour_points": len(contour),
+            "points_removed": removed,
+            "vertices": len(vertices),
+            "triangles": len(faces),
+            "stl_bytes": stl_bytes,
+            "preview_bytes": preview_bytes,
+        }
+    
+    def _write_preview(self, output_path: str, vertices, faces):
+        """Write the decimated web preview next to a mesh file, if enabled"""
+        if not self.preview_triangles:
+            return 0
+        vertices, faces = decimate(vertices, faces, self.preview_triangles)
+        return write_preview(preview_path(output_path), vertices, faces)
     
     def _create_simple_key_stl(self, output_path: str):
-        """Create a simple key-shaped STL as fallback"""
+        """Create a simple key-shaped STL (or output_format file) as fallback"""
         # Create a simple rectangular key shape
-        box = trimesh.creation.box(extents=[self.key_length, self.key_width, self.key_thickness])
-        box.export(output_path)
+        vertices, faces = box([self.key_length, self.key_width, self.key_thickness])
+        self._write_preview(output_path, vertices, faces)
+        return write_mesh(output_path, vertices, faces, self.output_format, self.output_precision)
@@ -0,0 +1,123 @@
+"""Keygen license validation for the API
+
+Validation goes through one pooled async HTTP client with timeouts. Results
+are cached for a TTL, invalid keys included (with a shorter TTL), and
+concurrent checks of the same key share a single request to Keygen.
+
+Only a 200 answer is about the key. Any other status (a server error, rate
+limiting, or a 401/403 from a bad product token or account id) raises
+LicenseServiceError and is not cached, so the next check asks again and
+our own misconfiguration never reaches users as "invalid license".
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import httpx
+
+KEYGEN_API_URL = "https://api.keygen.sh"
+
+
+class LicenseServiceError(Exception):
+    """Keygen did not answer whether the key is valid"""
+
+
+class LicenseValidator:
+    """Pooled, cached and coalescing client for Keygen's validate-key action"""
+
+    def __init__(self, account_id: str, product_token: str, base_url: str = KEYGEN_API_URL,
+                 valid_ttl: float = 300.0, invalid_ttl: float = 60.0, timeout: float = 5.0,
+                 max_entries: int = 10000, client: httpx.AsyncClient = None):
+        self.account_id = account_id
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.max_entries = max_entries
+        self._client = client or httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            headers={
+                "Authorization": f"Bearer {product_token}",
+                "Content-Type": "application/vnd.api+json",
+                "Accept": "application/vnd.api+json",
+            },
+        )
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def validate(self, key: str) -> dict:
+        """Validate a license key, answering from cache when possible"""
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires_at, result = cached
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return result
+            del self._cache[key]
+        self.misses += 1
+
+        # Coalesce identical in-flight validations into one request
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one cancelled caller does not cancel the shared request
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str) -> dict:
+        response = await self._client.post(
+            f"/v1/accounts/{self.account_id}/licenses/actions/validate-key",
+            json={"meta": {"key": key}},
+        )
+        # Anything but a 200 is not an answer about the key, so never cache it
+        if response.status_code != 200:
+            try:
+                detail = (response.json().get("errors") or [{}])[0].get("detail")
+            except ValueError:
+                detail = None
+            raise LicenseServiceError(
+                f"License server error ({response.status_code})" + (f": {detail}" if detail else "")
+            )
+        result = response.json()
+        meta = result.get("meta", {})
+
+        if meta.get("valid"):
+            data = {
+                "valid": True,
+                "license_id": result.get("data", {}).get("id"),
+                "message": "License validated successfully"
+            }
+            ttl = self.valid_ttl
+        else:
+            data = {
+                "valid": False,
+                "message": meta.get("detail") or "Invalid license key"
+            }
+            ttl = self.invalid_ttl
+
+        self._store(key, data, ttl)
+        return data
+
+    def _store(self, key: str, data: dict, ttl: float):
+        if ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + ttl, data)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._cache),
+            "inflight": len(self._inflight),
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
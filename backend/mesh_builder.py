@@ -0,0 +1,205 @@
+"""Vectorized mesh construction shared by KeyProcessor and test_conversion.py
+
+Every builder returns a ``(vertices, faces)`` pair: an ``(N, 3)`` float array
+of vertex positions and an ``(M, 3)`` integer array of vertex indices.
+"""
+
+import mapbox_earcut
+import numpy as np
+
+# Faces joining two consecutive 4-vertex cross-sections of a lofted profile,
+# wound counter-clockwise seen from outside (x increasing along the loft).
+# Cross-section vertex order: bottom-left, bottom-right, top-left, top-right.
+_LOFT_FACES = np.array([
+    # Bottom face
+    [0, 1, 4], [1, 5, 4],
+    # Top face
+    [2, 6, 3], [3, 6, 7],
+    # Side faces
+    [0, 4, 2], [4, 6, 2],
+    [1, 3, 5], [3, 7, 5],
+])
+
+# End caps closing the first (facing -x) and last (facing +x) cross-section
+_LOFT_START_CAP = np.array([[0, 3, 1], [0, 2, 3]])
+_LOFT_END_CAP = np.array([[0, 1, 3], [0, 3, 2]])
+
+
+def ring_wall_faces(n, bottom_start=0, top_start=None):
+    """Faces for the side wall between two closed rings of n vertices"""
+    if top_start is None:
+        top_start = bottom_start + n
+    i = np.arange(n)
+    j = (i + 1) % n
+    v1 = bottom_start + i
+    v2 = bottom_start + j
+    v3 = top_start + i
+    v4 = top_start + j
+    # Two triangles per side quad
+    quads = np.stack([
+        np.stack([v1, v2, v3], axis=1),
+        np.stack([v2, v4, v3], axis=1),
+    ], axis=1)
+    return quads.reshape(-1, 3)
+
+
+def is_closed(faces):
+    """Whether every directed edge is matched by exactly one opposite edge
+
+    True for a watertight mesh with consistent winding.
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    if len(faces) == 0:
+        return False
+    n = int(faces.max()) + 1
+    starts = faces.ravel()
+    ends = faces[:, [1, 2, 0]].ravel()
+    forward = np.sort(starts * n + ends)
+    backward = np.sort(ends * n + starts)
+    return bool(np.all(forward[1:] != forward[:-1]) and np.array_equal(forward, backward))
+
+
+def signed_volume(vertices, faces):
+    """Enclosed volume of a closed mesh, negative when its faces point inwards"""
+    triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces)]
+    return float(np.einsum("ij,ij->i", triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])).sum() / 6)
+
+
+def signed_area(points):
+    """Shoelace signed area of a closed 2D ring (positive when counter-clockwise)"""
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def clean_ring(points):
+    """Drop repeated and zero-area (collinear or spike) points from a closed ring
+
+    The triangulator silently skips such points, which would leave the walls
+    referencing edges that no cap triangle shares. Removing them up front
+    keeps the extruded mesh watertight without changing the enclosed region.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    while len(points) >= 3:
+        prev = np.roll(points, 1, axis=0)
+        nxt = np.roll(points, -1, axis=0)
+        cross = ((points[:, 0] - prev[:, 0]) * (nxt[:, 1] - prev[:, 1])
+                 - (points[:, 1] - prev[:, 1]) * (nxt[:, 0] - prev[:, 0]))
+        keep = cross != 0
+        if keep.all():
+            break
+        points = points[keep]
+    return points
+
+
+def triangulate_polygon(outer, holes=()):
+    """Triangulate a polygon with holes using z-order-hashed ear clipping
+
+    Returns the stacked ring points (outer first, then each hole) and
+    counter-clockwise faces indexing into them.
+    """
+    rings = [outer] + list(holes)
+    points = np.concatenate(rings)
+    ring_ends = np.cumsum([len(ring) for ring in rings]).astype(np.uint32)
+
+    faces = mapbox_earcut.triangulate_float64(points, ring_ends).reshape(-1, 3).astype(np.int64)
+    if len(faces) == 0:
+        raise ValueError("Could not triangulate key outline")
+
+    # Normalise winding to counter-clockwise
+    tri = points[faces]
+    cross = ((tri[:, 1, 0] - tri[:, 0, 0]) * (tri[:, 2, 1] - tri[:, 0, 1])
+             - (tri[:, 1, 1] - tri[:, 0, 1]) * (tri[:, 2, 0] - tri[:, 0, 0]))
+    faces[cross < 0] = faces[cross < 0][:, ::-1]
+    return points, faces
+
+
+def extrude_contour(points, thickness, holes=()):
+    """Extrude a closed 2D contour (and optional holes) into a watertight slab"""
+    # Outer ring counter-clockwise, holes clockwise, so walls face outwards
+    outer = clean_ring(points)
+    if len(outer) < 3:
+        raise ValueError("Key outline has too few points to mesh")
+    if signed_area(outer) < 0:
+        outer = outer[::-1]
+    rings = [outer]
+    for hole in holes:
+        hole = clean_ring(hole)
+        if len(hole) < 3:
+            continue
+        if signed_area(hole) > 0:
+            hole = hole[::-1]
+        rings.append(hole)
+
+    ring_points, cap_faces = triangulate_polygon(rings[0], rings[1:])
+    n = len(ring_points)
+
+    # Bottom layer (z=0) followed by top layer (z=thickness)
+    vertices = np.zeros((2 * n, 3))
+    vertices[:n, :2] = ring_points
+    vertices[n:, :2] = ring_points
+    vertices[n:, 2] = thickness
+
+    # Side walls for every ring
+    faces = []
+    start = 0
+    for ring in rings:
+        faces.append(ring_wall_faces(len(ring), start, n + start))
+        start += len(ring)
+
+    # Bottom cap faces down, top cap faces up
+    faces.append(cap_faces[:, ::-1])
+    faces.append(cap_faces + n)
+    return vertices, np.concatenate(faces)
+
+
+def loft_profile(xs, heights, half_width):
+    """Loft a rectangular cross-section along x with a varying top height
+
+    The result is a closed solid with outward-facing triangles; ``xs`` must
+    increase and every height be positive. Raises ValueError otherwise.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    heights = np.asarray(heights, dtype=np.float64)
+    m = len(xs)
+
+    # Four vertices per sample: bottom pair at z=0, top pair at the height
+    vertices = np.zeros((m, 4, 3))
+    vertices[:, :, 0] = xs[:, None]
+    vertices[:, [0, 2], 1] = -half_width
+    vertices[:, [1, 3], 1] = half_width
+    vertices[:, 2:, 2] = heights[:, None]
+
+    # Join each consecutive pair of cross-sections, then close both ends
+    offsets = np.arange(max(m - 1, 0)) * 4
+    faces = np.concatenate([
+        _LOFT_START_CAP,
+        (offsets[:, None, None] + _LOFT_FACES[None, :, :]).reshape(-1, 3),
+        _LOFT_END_CAP + (m - 1) * 4,
+    ])
+    vertices = vertices.reshape(-1, 3)
+
+    if m < 2 or not is_closed(faces) or signed_volume(vertices, faces) <= 0:
+        raise ValueError("Lofted profile is not a closed solid (needs increasing x and positive heights)")
+    return vertices, faces
+
+
+def box(extents):
+    """Axis-aligned box centred on the origin"""
+    hx, hy, hz = np.asarray(extents, dtype=np.float64) / 2
+    vertices = np.array([
+        [-hx, -hy, -hz], [hx, -hy, -hz], [hx, hy, -hz], [-hx, hy, -hz],
+        [-hx, -hy, hz], [hx, -hy, hz], [hx, hy, hz], [-hx, hy, hz],
+    ])
+    faces = np.array([
+        # Bottom and top
+        [0, 2, 1], [0, 3, 2],
+        [4, 5, 6], [4, 6, 7],
+        # Front and back
+        [0, 1, 5], [0, 5, 4],
+        [2, 3, 7], [2, 7, 6],
+        # Left and right
+        [3, 0, 4], [3, 4, 7],
+        [1, 2, 6], [1, 6, 5],
+    ])
+    return vertices, faces
+
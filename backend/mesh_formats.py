@@ -0,0 +1,276 @@
+"""Mesh output formats
+
+Binary STL stores all three corners of every triangle, so each vertex is
+repeated about six times. 3MF stores an indexed mesh (a vertex list plus
+triangles referencing it) as deflate-compressed XML, which slicers such as
+PrusaSlicer, Cura and Bambu Studio open directly.
+
+Before writing 3MF, vertices are snapped to a grid of ``precision`` mm and
+duplicates are merged, so the file holds each distinct vertex once with
+only as many decimals as the precision needs.
+
+Web previews use a low-poly copy of the mesh (``decimate``) in a compact
+binary format (``write_preview``), stored next to the print mesh as
+``<mesh file>.preview``:
+
+    magic     4 bytes   b"KPRV"
+    version   uint16    1
+    flags     uint16    bit 0 set: uint32 indices, else uint16
+    vertices  uint32    vertex count V
+    triangles uint32    triangle count T
+    origin    3 float32 position of quantized 0
+    scale     3 float32 position step per quantized unit
+    positions 3V uint16 x, y, z per vertex (origin + q * scale)
+    padding   to a multiple of 4 bytes
+    indices   3T uint16 or uint32
+
+All values are little-endian, so a browser can view the arrays directly
+with typed arrays.
+"""
+
+import math
+import struct
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from stl_writer import write_binary_stl
+
+DEFAULT_PRECISION = 0.001
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+    '</Types>'
+)
+
+RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+    'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+    '</Relationships>'
+)
+
+MODEL_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<model unit="millimeter" xml:lang="en-US" '
+    'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">'
+    '<resources><object id="1" type="model"><mesh><vertices>'
+)
+MODEL_MIDDLE = '</vertices><triangles>'
+TRIANGLE = '<triangle v1="{}" v2="{}" v3="{}"/>'
+MODEL_FOOTER = '</triangles></mesh></object></resources><build><item objectid="1"/></build></model>'
+
+# Fixed timestamp so the same mesh always gives the same bytes
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+CHUNK_SIZE = 65536
+
+
+def quantize_mesh(vertices, faces, precision: float = DEFAULT_PRECISION):
+    """Snap vertices to a ``precision`` grid and merge duplicates
+
+    Returns the distinct vertices and the faces re-indexed onto them.
+    Triangles that collapse to a line or point on the grid are dropped.
+    """
+    grid = np.round(np.asarray(vertices, dtype=np.float64) / precision).astype(np.int64)
+    unique, inverse = np.unique(grid, axis=0, return_inverse=True)
+    faces = inverse.reshape(-1)[np.asarray(faces)]
+
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])
+    return unique * precision, faces[keep]
+
+
+def _decimals(precision: float) -> int:
+    """Decimal places needed to write coordinates on a ``precision`` grid"""
+    return max(0, math.ceil(-math.log10(precision) - 1e-9))
+
+
+def _xml_rows(template: str, rows) -> bytes:
+    """Format every row of an array into one element each"""
+    # One str.format over a repeated template is several times faster than np.savetxt
+    return (template * len(rows)).format(*rows.ravel().tolist()).encode()
+
+
+def _zip_entry(name: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+class _CountingWriter:
+    """Write-only stream wrapper that counts bytes (and so needs no seeking)"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        self.stream.flush()
+
+
+def write_3mf(destination, vertices, faces, precision: float = DEFAULT_PRECISION) -> int:
+    """Write a mesh as a 3MF package to a path or file-like object
+
+    Returns the number of bytes written.
+    """
+    if isinstance(destination, (str, Path)):
+        with open(destination, "wb") as f:
+            return write_3mf(f, vertices, faces, precision)
+
+    vertices, faces = quantize_mesh(vertices, faces, precision)
+    number = f"{{:.{_decimals(precision)}f}}"
+    vertex = f'<vertex x="{number}" y="{number}" z="{number}"/>'
+
+    out = _CountingWriter(destination)
+    with zipfile.ZipFile(out, "w") as package:
+        package.writestr(_zip_entry("[Content_Types].xml"), CONTENT_TYPES)
+        package.writestr(_zip_entry("_rels/.rels"), RELATIONSHIPS)
+        # Stream the model in chunks rather than building the whole XML string
+        with package.open(_zip_entry("3D/3dmodel.model"), "w") as model:
+            model.write(MODEL_HEADER.encode())
+            for first in range(0, len(vertices), CHUNK_SIZE):
+                model.write(_xml_rows(vertex, vertices[first:first + CHUNK_SIZE]))
+            model.write(MODEL_MIDDLE.encode())
+            for first in range(0, len(faces), CHUNK_SIZE):
+                model.write(_xml_rows(TRIANGLE, faces[first:first + CHUNK_SIZE]))
+            model.write(MODEL_FOOTER.encode())
+    return out.bytes_written
+
+
+def _write_stl(destination, vertices, faces, precision=DEFAULT_PRECISION):
+    # STL has no shared vertices to merge, so it is written as is
+    return write_binary_stl(destination, vertices, faces)
+
+
+# Format name: (file suffix, writer)
+MESH_FORMATS = {
+    "stl": (".stl", _write_stl),
+    "3mf": (".3mf", write_3mf),
+}
+
+
+def mesh_suffix(fmt: str) -> str:
+    """File suffix for a mesh format name"""
+    return MESH_FORMATS[fmt][0]
+
+
+def write_mesh(destination, vertices, faces, fmt: str = "stl", precision: float = DEFAULT_PRECISION) -> int:
+    """Write a mesh in the named format, returning the number of bytes written
+
+    Raises ValueError for an unknown format.
+    """
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format: {fmt}")
+    return MESH_FORMATS[fmt][1](destination, vertices, faces, precision)
+
+
+PREVIEW_SUFFIX = ".preview"
+PREVIEW_MAGIC = b"KPRV"
+PREVIEW_HEADER = struct.Struct("<4sHHII3f3f")
+PREVIEW_WIDE_INDICES = 1
+
+# Triangle budget for web previews
+DEFAULT_PREVIEW_TRIANGLES = 2000
+
+
+def preview_path(path) -> Path:
+    """Where the web preview of a mesh file lives"""
+    path = Path(path)
+    return path.with_name(path.name + PREVIEW_SUFFIX)
+
+
+def decimate(vertices, faces, max_triangles: int = DEFAULT_PREVIEW_TRIANGLES):
+    """Reduce a mesh to at most ``max_triangles`` by vertex clustering
+
+    Vertices are merged per cell of a grid over the bounding box and moved
+    to the mean of their cell; triangles that collapse or duplicate another
+    are dropped. Every axis gets the same number of cells over its own
+    extent, so thin parts such as the key blade keep their thickness. The
+    grid starts fine and is coarsened until the budget is met. Meshes
+    already within budget are returned unchanged.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+    if len(faces) <= max_triangles:
+        return vertices, faces
+
+    low = vertices.min(axis=0)
+    extent = np.maximum(vertices.max(axis=0) - low, 1e-9)
+    # Start well above the cells a surface of this budget needs, then coarsen
+    cells = max(int(math.sqrt(max_triangles) * 4), 2)
+    while True:
+        # One integer per cell (indices run 0..cells on each axis)
+        index = np.floor((vertices - low) / (extent / cells)).astype(np.int64)
+        keys = (index[:, 0] * (cells + 1) + index[:, 1]) * (cells + 1) + index[:, 2]
+        _, cluster, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        centres = np.zeros((len(counts), 3))
+        np.add.at(centres, cluster, vertices)
+        centres /= counts[:, None]
+
+        merged = cluster[faces]
+        merged = merged[(merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2])
+                        & (merged[:, 2] != merged[:, 0])]
+        # The same three clusters can come from several triangles
+        _, first = np.unique(np.sort(merged, axis=1), axis=0, return_index=True)
+        merged = merged[np.sort(first)]
+        if len(merged) <= max_triangles or cells <= 2:
+            break
+        # Surface triangles grow with the square of the cells per axis
+        cells = max(min(int(cells * math.sqrt(max_triangles / len(merged)) * 0.95), cells - 1), 2)
+
+    # Drop clusters no remaining triangle uses
+    used, remap = np.unique(merged, return_inverse=True)
+    return centres[used], remap.reshape(merged.shape)
+
+
+def write_preview(destination, vertices, faces) -> int:
+    """Write a mesh in the compact preview format to a path or file-like object
+
+    Returns the number of bytes written.
+    """
+    if isinstance(destination, (str, Path)):
+        with open(destination, "wb") as f:
+            return write_preview(f, vertices, faces)
+
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+    low = vertices.min(axis=0) if len(vertices) else np.zeros(3)
+    high = vertices.max(axis=0) if len(vertices) else np.zeros(3)
+    scale = np.where(high > low, (high - low) / 65535, 1.0)
+    positions = np.round((vertices - low) / scale).astype("<u2")
+
+    wide = len(vertices) > 65536
+    indices = faces.astype("<u4" if wide else "<u2")
+    header = PREVIEW_HEADER.pack(PREVIEW_MAGIC, 1, PREVIEW_WIDE_INDICES if wide else 0,
+                                 len(vertices), len(faces), *low, *scale)
+    padding = b"\0" * (-(len(header) + positions.nbytes) % 4)
+    for part in (header, positions.tobytes(), padding, indices.tobytes()):
+        destination.write(part)
+    return len(header) + positions.nbytes + len(padding) + indices.nbytes
+
+
+def read_preview(data: bytes):
+    """Decode a preview written by write_preview into (vertices, faces)"""
+    magic, version, flags, vertex_count, triangle_count, *rest = PREVIEW_HEADER.unpack_from(data)
+    if magic != PREVIEW_MAGIC or version != 1:
+        raise ValueError("Not a mesh preview")
+    origin, scale = np.array(rest[:3]), np.array(rest[3:])
+    offset = PREVIEW_HEADER.size
+    positions = np.frombuffer(data, "<u2", vertex_count * 3, offset).reshape(-1, 3)
+    offset += positions.nbytes + (-(offset + positions.nbytes) % 4)
+    dtype = "<u4" if flags & PREVIEW_WIDE_INDICES else "<u2"
+    faces = np.frombuffer(data, dtype, triangle_count * 3, offset).reshape(-1, 3)
+    return origin + positions * scale, faces.astype(np.int64)
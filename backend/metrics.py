@@ -0,0 +1,218 @@
+"""Conversion and request metrics
+
+KeyProcessor reports one record per conversion: the stats dict with its
+per-stage ``timings_ms``, mesh sizes, bytes written and whether it fell back
+to the placeholder box. Any callable that takes such a record is a sink:
+
+- ``MetricsRegistry.record_conversion`` folds records into counters and
+  latency histograms, rendered as Prometheus text or JSON (``/metrics``)
+- ``LogSink`` logs one line per conversion
+- ``JSONLinesSink`` appends each record to a JSON-lines file
+
+LogSink and JSONLinesSink are picklable, so a KeyProcessor with one of them
+attached can still be sent to a worker process.
+"""
+
+import json
+import logging
+import threading
+from typing import Optional
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_HELP = {
+    "keystl_conversions_total": ("counter", "STL conversions by detector and outcome"),
+    "keystl_fallbacks_total": ("counter", "Conversions that fell back to the placeholder box"),
+    "keystl_stl_bytes_total": ("counter", "Bytes of STL written"),
+    "keystl_triangles_total": ("counter", "Triangles written to STL files"),
+    "keystl_stage_seconds": ("histogram", "Time spent in each conversion stage"),
+    "keystl_conversion_seconds": ("histogram", "Total conversion time inside the worker"),
+    "keystl_job_seconds": ("histogram", "Time from job submission to completion"),
+    "keystl_http_request_seconds": ("histogram", "HTTP request latency by endpoint"),
+    "keystl_download_bytes_total": ("counter", "Download body bytes by kind (mesh or preview) and content encoding"),
+}
+
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in items
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, cumulative count) pairs ending with +Inf"""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((bound, total))
+        pairs.append((float("inf"), self.count))
+        return pairs
+
+
+class MetricsRegistry:
+    """Thread-safe labelled counters and histograms"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def record_conversion(self, record: dict):
+        """Sink: fold one KeyProcessor conversion record into the metrics"""
+        detector = record.get("detector", "unknown")
+        fallback = bool(record.get("fallback"))
+        if fallback:
+            outcome = "fallback"
+        elif record.get("error"):
+            outcome = "error"
+        else:
+            outcome = "ok"
+        self.inc("keystl_conversions_total", detector=detector, outcome=outcome)
+        if fallback:
+            self.inc("keystl_fallbacks_total", detector=detector)
+        self.inc("keystl_stl_bytes_total", record.get("stl_bytes", 0))
+        self.inc("keystl_triangles_total", record.get("triangles", 0))
+
+        timings = record.get("timings_ms", {})
+        for stage, ms in timings.items():
+            if stage != "total":
+                self.observe("keystl_stage_seconds", ms / 1000, stage=stage)
+        if "total" in timings:
+            self.observe("keystl_conversion_seconds", timings["total"] / 1000)
+        # Detection steps (blur, edges, contours, ...) as detect.<step>
+        for step, ms in record.get("detection_ms", {}).items():
+            if step != "total":
+                self.observe("keystl_stage_seconds", ms / 1000, stage=f"detect.{step}")
+
+    def to_dict(self) -> dict:
+        """JSON-friendly snapshot of every metric"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": {("+Inf" if bound == float("inf") else str(bound)): count
+                                for bound, count in histogram.cumulative()},
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self, gauges: Optional[dict] = None) -> str:
+        """Prometheus text exposition format
+
+        ``gauges`` maps extra metric names to current values, e.g. cache and
+        queue sizes that are owned elsewhere.
+        """
+        lines = []
+        described = set()
+
+        def describe(name, default_type):
+            if name not in described:
+                described.add(name)
+                metric_type, text = METRIC_HELP.get(name, (default_type, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                describe(name, "counter")
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                describe(name, "histogram")
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for name, value in sorted((gauges or {}).items()):
+            describe(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class LogSink:
+    """Sink: log one summary line per conversion"""
+
+    def __init__(self, logger_name: str = "keystl.metrics", level: int = logging.INFO):
+        self.logger_name = logger_name
+        self.level = level
+
+    def __call__(self, record: dict):
+        timings = record.get("timings_ms", {})
+        stages = " ".join(f"{stage}={ms:.1f}ms" for stage, ms in timings.items())
+        logging.getLogger(self.logger_name).log(
+            self.level, "conversion %s detector=%s triangles=%s bytes=%s fallback=%s %s",
+            record.get("image"), record.get("detector"), record.get("triangles"),
+            record.get("stl_bytes"), bool(record.get("fallback")), stages,
+        )
+
+
+class JSONLinesSink:
+    """Sink: append each conversion record as one JSON line"""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    def __call__(self, record: dict):
+        # A single O_APPEND write per record keeps lines whole across processes
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def sink_from_spec(spec: str):
+    """Build a sink from a config string: ``log`` or ``json:<path>``"""
+    if spec == "log":
+        return LogSink()
+    if spec.startswith("json:"):
+        return JSONLinesSink(spec[len("json:"):])
+    raise ValueError(f"Unknown metrics sink: {spec}")
@@ -0,0 +1,356 @@
+"""Content-addressed cache and storage manager for uploads and STL files
+
+Results are keyed on the SHA-256 of the uploaded image bytes plus the
+KeyProcessor parameters that produced them, so re-uploading the same photo
+returns the existing STL instead of converting it again.
+
+Files are sharded by the first two byte pairs of their key
+(``stl_files/ab/cd/key_abcd....stl``) so no directory grows huge. The cache
+is bounded by the total size of the cached STL and upload files, evicting
+the least recently used entries first, and entries unused for longer than
+a TTL are removed by a background sweeper. The in-memory index answers
+download lookups, so requests for unknown files never touch the disk.
+
+An entry may hold several STL files when one photo had several keys
+(``key_<key>.stl``, ``key_<key>_1.stl``, ...). Each STL file may have a
+gzip copy next to it (``key_<key>.stl.gz``, see downloads.py), which is
+counted and removed with it, as is its web preview (``key_<key>.stl.preview``,
+see mesh_formats.py). Results requested as 3MF are stored as
+``key_<key>.3mf`` and handled the same way.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from mesh_formats import preview_path
+
+logger = logging.getLogger(__name__)
+
+STL_NAME = re.compile(r"^key_([0-9a-f]{64})(?:_([1-9][0-9]*))?\.(?:stl|3mf)$")
+UPLOAD_NAME = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]{1,5})?$")
+
+# Unfinished upload files older than this are left over from failed requests
+PART_FILE_TTL = 3600
+
+
+class CacheEntry(NamedTuple):
+    stl_paths: tuple
+    upload_path: Optional[Path]
+    size: int
+
+    @property
+    def stl_path(self) -> Path:
+        """The first (or only) STL file"""
+        return self.stl_paths[0]
+
+
+def key_hasher(params: dict):
+    """Start a cache key hash seeded with the processor parameters
+
+    Feed the image bytes with ``update()`` (all at once or chunk by chunk)
+    and take ``hexdigest()`` as the cache key.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(params, sort_keys=True).encode())
+    h.update(b"\0")
+    return h
+
+
+def make_key(image_bytes: bytes, params: dict) -> str:
+    """Cache key for an image and the processor parameters"""
+    h = key_hasher(params)
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+def stl_filename(key: str, index: int = 0, suffix: str = ".stl") -> str:
+    """Mesh file name for a cache key, the key's index in the photo and the format suffix"""
+    return f"key_{key}{suffix}" if index == 0 else f"key_{key}_{index}{suffix}"
+
+
+def shard(key: str) -> Path:
+    """Relative shard directory for a cache key"""
+    return Path(key[:2], key[2:4])
+
+
+def _file_size(path: Optional[Path]) -> int:
+    try:
+        return path.stat().st_size if path else 0
+    except FileNotFoundError:
+        return 0
+
+
+def _unlink(path: Optional[Path]):
+    if path is not None:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def gzip_path(path) -> Path:
+    """Where the precompressed copy of a stored STL file lives"""
+    path = Path(path)
+    return path.with_name(path.name + ".gz")
+
+
+def _with_sidecars(path: Path):
+    """A stored mesh file plus its gzip copy, preview and gzipped preview"""
+    preview = preview_path(path)
+    return path, gzip_path(path), preview, gzip_path(preview)
+
+
+def _entry_size(stl_paths, upload_path: Optional[Path]) -> int:
+    return sum(_file_size(file) for path in stl_paths for file in _with_sidecars(path)) + _file_size(upload_path)
+
+
+def _unlink_entry(entry: CacheEntry):
+    for path in entry.stl_paths:
+        for file in _with_sidecars(path):
+            _unlink(file)
+    _unlink(entry.upload_path)
+
+
+class ResultCache:
+    """Size- and age-bounded LRU index over STL_DIR and UPLOAD_DIR
+
+    ``ttl`` is in seconds since an entry was last stored or read (0 keeps
+    entries until evicted for space).
+    """
+
+    def __init__(self, stl_dir: Path, upload_dir: Path, max_bytes: int, ttl: float = 0):
+        self.stl_dir = Path(stl_dir)
+        self.upload_dir = Path(upload_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop_sweeping = threading.Event()
+        self._load_existing()
+
+    def _load_existing(self):
+        """Rebuild the index from files left by a previous run, oldest first
+
+        Flat files from before sharding are indexed where they are.
+        """
+        uploads = {}
+        for path in self.upload_dir.rglob("*"):
+            match = UPLOAD_NAME.match(path.name)
+            if match and path.is_file():
+                uploads[match.group(1)] = path
+
+        found = {}
+        for path in self.stl_dir.rglob("key_*"):
+            match = STL_NAME.match(path.name)
+            if match:
+                found.setdefault(match.group(1), []).append((int(match.group(2) or 0), path))
+
+        # Only the first file of an entry is touched on reads, so it dates the entry
+        by_age = []
+        for key, files in found.items():
+            files.sort()
+            paths = tuple(path for _, path in files)
+            if files[0][0] == 0:
+                by_age.append((paths[0].stat().st_mtime, key, paths))
+            else:
+                # Left over from an entry whose first file was removed
+                for path in paths:
+                    for file in _with_sidecars(path):
+                        _unlink(file)
+
+        for mtime, key, paths in sorted(by_age):
+            upload_path = uploads.get(key)
+            size = _entry_size(paths, upload_path)
+            self._entries[key] = CacheEntry(paths, upload_path, size)
+            self._last_used[key] = mtime
+            self.total_bytes += size
+        self._evict()
+
+    def upload_path(self, key: str, filename: str) -> Path:
+        """Where to store the upload for a cache key, keeping a safe image suffix"""
+        suffix = Path(filename or "").suffix.lower()
+        if not re.fullmatch(r"\.[a-z0-9]{1,5}", suffix):
+            suffix = ""
+        directory = self.upload_dir / shard(key)
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory / f"{key}{suffix}"
+
+    def stl_path(self, key: str, index: int = 0, suffix: str = ".stl") -> Path:
+        """Where to store the mesh file for a cache key (and key index in the photo)"""
+        directory = self.stl_dir / shard(key)
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory / stl_filename(key, index, suffix)
+
+    def _expired(self, key: str, now: float) -> bool:
+        return self.ttl > 0 and self._last_used[key] < now - self.ttl
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Look up a cached result, counting the hit or miss"""
+        now = time.time()
+        stale = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(key, now):
+                # Expired but not swept yet
+                stale = self._drop(key)
+                self.expirations += 1
+                entry = None
+            elif entry is not None and not entry.stl_path.exists():
+                # Removed behind our back
+                self._drop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                self._last_used[key] = now
+
+        if stale is not None:
+            _unlink_entry(stale)
+        if entry is None:
+            return None
+        try:
+            os.utime(entry.stl_path)
+        except OSError:
+            pass
+        return entry
+
+    def lookup_stl(self, filename: str) -> Optional[Path]:
+        """Path of a live STL by its download file name, from the index only
+
+        Unknown names are answered without touching the disk. Does not
+        count as a cache hit or refresh the entry.
+        """
+        match = STL_NAME.match(filename)
+        if not match:
+            return None
+        with self._lock:
+            entry = self._entries.get(match.group(1))
+            if entry is None or self._expired(match.group(1), time.time()):
+                return None
+            return next((path for path in entry.stl_paths if path.name == filename), None)
+
+    def put(self, key: str, stl_paths, upload_path: Optional[Path] = None) -> CacheEntry:
+        """Record a freshly generated result and evict old entries if over budget
+
+        ``stl_paths`` is the STL file, or a list of them for several keys.
+        """
+        if isinstance(stl_paths, (str, Path)):
+            stl_paths = [stl_paths]
+        stl_paths = tuple(Path(path) for path in stl_paths)
+        entry = CacheEntry(stl_paths, upload_path, _entry_size(stl_paths, upload_path))
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key).size
+            self._entries[key] = entry
+            self._last_used[key] = time.time()
+            self.total_bytes += entry.size
+            self._evict(keep=key)
+        return entry
+
+    def discard(self, stl_paths, upload_path: Optional[Path] = None):
+        """Delete the files of a result that is not to be cached, such as a fallback
+
+        Left on disk they would be indexed again at the next startup.
+        """
+        if isinstance(stl_paths, (str, Path)):
+            stl_paths = [stl_paths]
+        _unlink_entry(CacheEntry(tuple(Path(path) for path in stl_paths), upload_path, 0))
+
+    def _drop(self, key: str) -> CacheEntry:
+        entry = self._entries.pop(key)
+        del self._last_used[key]
+        self.total_bytes -= entry.size
+        return entry
+
+    def _evict(self, keep: Optional[str] = None):
+        """Remove least recently used entries until under max_bytes"""
+        while self.total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            entry = self._drop(key)
+            self.evictions += 1
+            _unlink_entry(entry)
+
+    def sweep(self) -> int:
+        """Delete expired entries and stale unfinished uploads
+
+        Returns the number of entries expired.
+        """
+        now = time.time()
+        expired = []
+        with self._lock:
+            # Entries are in least recently used order, so expired ones lead
+            for key in list(self._entries):
+                if not self._expired(key, now):
+                    break
+                expired.append(self._drop(key))
+            self.expirations += len(expired)
+
+        # Delete outside the lock so lookups are not held up by the disk
+        for entry in expired:
+            _unlink_entry(entry)
+
+        for path in self.upload_dir.glob("*.part"):
+            try:
+                if path.stat().st_mtime < now - PART_FILE_TTL:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+        return len(expired)
+
+    def start_sweeper(self, interval: float):
+        """Run sweep() every ``interval`` seconds on a daemon thread"""
+        if self._sweeper is not None or interval <= 0:
+            return
+        self._stop_sweeping.clear()
+
+        def run():
+            while not self._stop_sweeping.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Result cache sweep failed")
+
+        self._sweeper = threading.Thread(target=run, name="result-cache-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._stop_sweeping.set()
+            self._sweeper.join()
+            self._sweeper = None
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
@@ -0,0 +1,83 @@
+"""Streaming binary STL writer
+
+Writes facets straight from vertex and face arrays, a chunk at a time, so
+large meshes never need a second full in-memory representation.
+"""
+
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# One binary STL facet: normal, three vertices, attribute byte count
+FACET_DTYPE = np.dtype([
+    ("normal", "<f4", (3,)),
+    ("vertices", "<f4", (3, 3)),
+    ("attr", "<u2"),
+])
+
+HEADER = b"Binary STL written by key-to-stl"
+
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def facet_normals(triangles):
+    """Unit normals for an (M, 3, 3) array of triangles (zero for degenerate ones)"""
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, length, out=normals, where=length > 0)
+    return normals
+
+
+class BinarySTLWriter:
+    """Write binary STL facets to a file-like object in chunks
+
+    The facet count is part of the header, so it must be known up front.
+    This lets the writer stream to non-seekable outputs such as sockets
+    (wrap them with ``socket.makefile("wb")``).
+    """
+
+    def __init__(self, stream, facet_count: int, header: bytes = HEADER):
+        self.stream = stream
+        self.remaining = facet_count
+        self.bytes_written = 0
+        self._write(header[:80].ljust(80, b"\0") + struct.pack("<I", facet_count))
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.bytes_written += len(data)
+
+    def write(self, triangles):
+        """Write an (M, 3, 3) array of triangle corners"""
+        triangles = np.asarray(triangles, dtype=np.float64)
+        if len(triangles) > self.remaining:
+            raise ValueError("More facets written than declared in the STL header")
+        records = np.zeros(len(triangles), dtype=FACET_DTYPE)
+        records["normal"] = facet_normals(triangles)
+        records["vertices"] = triangles
+        self._write(records.tobytes())
+        self.remaining -= len(triangles)
+
+    def close(self):
+        """Check that every declared facet was written"""
+        if self.remaining:
+            raise ValueError(f"STL header declares {self.remaining} more facets than were written")
+
+
+def write_binary_stl(destination, vertices, faces, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Write an indexed mesh as binary STL to a path or file-like object
+
+    Returns the number of bytes written.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+
+    if isinstance(destination, (str, Path)):
+        with open(destination, "wb") as f:
+            return write_binary_stl(f, vertices, faces, chunk_size)
+
+    writer = BinarySTLWriter(destination, len(faces))
+    for start in range(0, len(faces), chunk_size):
+        writer.write(vertices[faces[start:start + chunk_size]])
+    writer.close()
+    return writer.bytes_written
@@ -4,16 +4,40 @@ STANDALONE TEST SCRIPT - Key to STL Converter
 No web server, no licensing - just pure image-to-STL conversion testing
 
 Usage:
-    python test_conversion.py path/to/key_image.jpg
+    python test_conversion.py path/to/key_image.jpg [--detector otsu]
+
+Batch mode (several files, directories or globs) converts across all CPU
+cores and records every result in a JSON-lines manifest. Rerunning the same
+command skips images the manifest already lists as converted:
+    python test_conversion.py scans/ "archive/**/*.jpg" -o stl_out
+
+--detector is one of canny (default), otsu, adaptive or downscale.
+--format 3mf writes compact indexed 3MF files instead of STL.
 """
 
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
 import sys
+import time
 import cv2
-import numpy as np
-from stl import mesh
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
+from contours import simplify_contour
+from detection import DEFAULT_BACKEND, available_backends, detect_key
+from mesh_builder import extrude_contour
+from mesh_formats import DEFAULT_PRECISION, MESH_FORMATS, mesh_suffix, write_mesh
+
+# Contour simplification tolerance in mesh units (the script meshes in pixels)
+SIMPLIFY_TOLERANCE = 1.0
 
-def process_key_image(image_path):
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+MANIFEST_NAME = "manifest.jsonl"
+
+def process_key_image(image_path, tolerance=SIMPLIFY_TOLERANCE, detector=DEFAULT_BACKEND):
     """Process a key image and generate STL file"""
     print(f"📸 Loading image: {image_path}")
     
@@ -24,106 +48,199 @@ def process_key_image(image_path):
     
     print(f"✅ Image loaded: {img.shape[1]}x{img.shape[0]} pixels")
     
-    # Convert to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # Apply Gaussian blur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    # Detect the key outline (the largest contour) and any holes in it
+    print(f"🔍 Detecting key ({detector})...")
+    detection = detect_key(img, detector)
+    key_contour = detection.contour
+    holes = detection.holes()
+    print(f"✅ Key contour found: {len(key_contour)} points, {len(holes)} hole(s) "
+          f"in {detection.timings['total']:.1f} ms")
     
-    # Edge detection
-    print("🔍 Detecting edges...")
-    edges = cv2.Canny(blurred, 50, 150)
-    
-    # Find contours
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    if not contours:
-        raise ValueError("No key detected in image")
-    
-    # Get the largest contour (assumed to be the key)
-    key_contour = max(contours, key=cv2.contourArea)
-    print(f"✅ Key contour found: {len(key_contour)} points")
+    # Simplify the outline before meshing
+    key_contour, removed = simplify_contour(key_contour, tolerance, 1.0)
+    holes = [simplify_contour(hole, tolerance, 1.0)[0] for hole in holes]
+    print(f"✅ Contour simplified: removed {removed} points, {len(key_contour)} remain")
     
     # Generate 3D mesh from contour
     print("🏗️  Building 3D mesh...")
-    vertices = []
-    faces = []
-    
     # Key thickness in mm
     thickness = 3.0
     
-    # Bottom layer (z=0)
-    for point in key_contour:
-        x, y = point[0]
-        vertices.append([float(x), float(y), 0.0])
-    
-    # Top layer (z=thickness)
-    for point in key_contour:
-        x, y = point[0]
-        vertices.append([float(x), float(y), thickness])
-    
-    # Create side faces
-    n = len(key_contour)
-    for i in range(n):
-        v1 = i
-        v2 = (i + 1) % n
-        v3 = i + n
-        v4 = (i + 1) % n + n
-        
-        # Two triangles per side face
-        faces.append([v1, v2, v3])
-        faces.append([v2, v4, v3])
-    
-    # Bottom face (triangulate)
-    for i in range(1, n-1):
-        faces.append([0, i, i+1])
-    
-    # Top face (triangulate)
-    for i in range(1, n-1):
-        faces.append([n, n+i+1, n+i])
-    
-    # Create STL mesh
-    vertices = np.array(vertices)
-    faces = np.array(faces)
-    
-    key_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-    for i, face in enumerate(faces):
-        for j in range(3):
-            key_mesh.vectors[i][j] = vertices[face[j]]
+    # Extrude the contour into walls plus triangulated bottom and top caps
+    vertices, faces = extrude_contour(
+        key_contour.reshape(-1, 2),
+        thickness,
+        holes=[hole.reshape(-1, 2) for hole in holes],
+    )
     
     print(f"✅ Mesh created: {len(faces)} triangles")
     
-    return key_mesh
+    return vertices, faces
 
-def save_stl(key_mesh, output_path):
-    """Save the mesh to an STL file"""
-    print(f"💾 Saving STL to: {output_path}")
-    key_mesh.save(str(output_path))
+def save_stl(key_mesh, output_path, fmt="stl", precision=DEFAULT_PRECISION):
+    """Save the (vertices, faces) mesh to a binary STL file (or another mesh format)"""
+    print(f"💾 Saving {fmt.upper()} to: {output_path}")
+    vertices, faces = key_mesh
+    write_mesh(output_path, vertices, faces, fmt, precision)
     file_size = Path(output_path).stat().st_size
-    print(f"✅ STL file saved: {file_size:,} bytes")
+    print(f"✅ {fmt.upper()} file saved: {file_size:,} bytes")
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python test_conversion.py <image_path>")
-        print("Example: python test_conversion.py key_photo.jpg")
-        sys.exit(1)
+def find_images(inputs):
+    """Expand files, directories (recursively) and glob patterns to (image, relative name) pairs
+
+    The relative name keeps a directory's sub-folders so outputs do not
+    collide; the result is sorted so reruns map images to the same outputs.
+    """
+    found = {}
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            for image in path.rglob("*"):
+                if image.suffix.lower() in IMAGE_SUFFIXES and image.is_file():
+                    found.setdefault(str(image.resolve()), image.relative_to(path))
+        elif path.is_file():
+            found.setdefault(str(path.resolve()), Path(path.name))
+        else:
+            for match in glob.glob(item, recursive=True):
+                image = Path(match)
+                if image.suffix.lower() in IMAGE_SUFFIXES and image.is_file():
+                    found.setdefault(str(image.resolve()), Path(image.name))
+    return sorted(found.items())
+
+def output_paths(images, output_dir, reserved=None, suffix=".stl"):
+    """Map each image to a unique <name>_key.stl (or other suffix) under output_dir
+
+    ``reserved`` maps already converted images to their outputs, which are
+    kept so images added since the last run never overwrite them. Outputs
+    are absolute, like the images, so a rerun from another directory finds
+    them.
+    """
+    reserved = reserved or {}
+    used = {Path(output) for output in reserved.values()}
+    jobs = []
+    for image, relative in images:
+        if image in reserved:
+            jobs.append((image, reserved[image]))
+            continue
+        base = Path(output_dir).resolve() / relative.parent / f"{relative.stem}_key"
+        output = base.with_suffix(suffix)
+        number = 1
+        while output in used:
+            output = Path(f"{base}_{number}{suffix}")
+            number += 1
+        used.add(output)
+        jobs.append((image, str(output)))
+    return jobs
+
+def read_manifest(manifest_path):
+    """Images already converted according to a manifest, with their outputs (last entry wins)"""
+    done = {}
+    if not Path(manifest_path).exists():
+        return done
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash
+                continue
+            if entry.get("status") == "ok" and Path(entry["output"]).exists():
+                done[entry["image"]] = entry["output"]
+            else:
+                done.pop(entry.get("image"), None)
+    return done
+
+def convert_file(image_path, output_path, tolerance=SIMPLIFY_TOLERANCE, detector=DEFAULT_BACKEND,
+                 fmt="stl", precision=DEFAULT_PRECISION):
+    """Convert one image for batch mode, returning its manifest entry"""
+    entry = {"image": image_path, "output": output_path}
+    start = time.perf_counter()
+    try:
+        # The single-image progress output would interleave across workers
+        with contextlib.redirect_stdout(io.StringIO()):
+            key_mesh = process_key_image(image_path, tolerance, detector)
+            processed = time.perf_counter()
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+            save_stl(key_mesh, output_path, fmt, precision)
+        entry.update(
+            status="ok",
+            triangles=len(key_mesh[1]),
+            stl_bytes=Path(output_path).stat().st_size,
+            process_seconds=round(processed - start, 4),
+            save_seconds=round(time.perf_counter() - processed, 4),
+        )
+    except Exception as e:
+        entry.update(status="error", error=str(e))
+    entry["seconds"] = round(time.perf_counter() - start, 4)
+    return entry
+
+def run_batch(inputs, output_dir, manifest_path=None, workers=None, tolerance=SIMPLIFY_TOLERANCE,
+              detector=DEFAULT_BACKEND, fmt="stl", precision=DEFAULT_PRECISION):
+    """Convert every image in inputs, appending results to the manifest
+
+    Images the manifest already records as converted are skipped. Returns
+    the number of failures.
+    """
+    manifest_path = manifest_path or Path(output_dir) / MANIFEST_NAME
+    Path(manifest_path).parent.mkdir(parents=True, exist_ok=True)
+    done = read_manifest(manifest_path)
+    jobs = output_paths(find_images(inputs), output_dir, reserved=done, suffix=mesh_suffix(fmt))
+    pending = [(image, output) for image, output in jobs if image not in done]
     
-    image_path = sys.argv[1]
+    print(f"🔎 Found {len(jobs)} image(s), {len(jobs) - len(pending)} already converted")
+    if not pending:
+        return 0
     
+    workers = workers or os.cpu_count()
+    failures = 0
+    finished = 0
+    start = time.perf_counter()
+    with open(manifest_path, "a") as manifest, ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded number of images in flight so huge backfills stay light
+        queue = iter(pending)
+        in_flight = set()
+        while True:
+            for image, output in queue:
+                in_flight.add(executor.submit(convert_file, image, output, tolerance, detector, fmt, precision))
+                if len(in_flight) >= workers * 4:
+                    break
+            if not in_flight:
+                break
+            completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                entry = future.result()
+                # One flushed line per image, so a crash loses nothing already done
+                manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                finished += 1
+                if entry["status"] == "ok":
+                    print(f"✅ [{finished}/{len(pending)}] {entry['image']} ({entry['seconds']:.2f}s)")
+                else:
+                    failures += 1
+                    print(f"❌ [{finished}/{len(pending)}] {entry['image']}: {entry['error']}")
+    
+    elapsed = time.perf_counter() - start
+    print(f"\n🎉 Converted {finished - failures}/{len(pending)} image(s) in {elapsed:.1f}s "
+          f"({finished / elapsed:.1f}/s), {failures} failed")
+    print(f"📄 Manifest: {manifest_path}")
+    return failures
+
+def convert_single(image_path, detector, tolerance=SIMPLIFY_TOLERANCE, fmt="stl", precision=DEFAULT_PRECISION):
+    """Convert one image with full progress output"""
     print("="*60)
     print("🔑 KEY TO STL CONVERSION TEST")
     print("="*60)
     
     try:
         # Process the image
-        key_mesh = process_key_image(image_path)
+        key_mesh = process_key_image(image_path, tolerance, detector)
         
         # Generate output filename
         input_name = Path(image_path).stem
-        output_path = f"{input_name}_key.stl"
+        output_path = f"{input_name}_key{mesh_suffix(fmt)}"
         
         # Save the STL
-        save_stl(key_mesh, output_path)
+        save_stl(key_mesh, output_path, fmt, precision)
         
         print("\n" + "="*60)
         print("🎉 SUCCESS! Your key has been converted to STL")
@@ -138,5 +255,31 @@ def main():
         print(f"\n❌ ERROR: {str(e)}")
         sys.exit(1)
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert key images to STL. One file converts in the foreground; several "
+                    "files, directories or globs run as a resumable batch.",
+    )
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("--detector", default=DEFAULT_BACKEND, choices=available_backends())
+    parser.add_argument("-o", "--output-dir", default=".", help="where batch STL files go (default: .)")
+    parser.add_argument("--manifest", help=f"batch manifest path (default: <output-dir>/{MANIFEST_NAME})")
+    parser.add_argument("-j", "--workers", type=int, help="batch worker processes (default: CPU count)")
+    parser.add_argument("--tolerance", type=float, default=SIMPLIFY_TOLERANCE,
+                        help=f"contour simplification tolerance in pixels (default: {SIMPLIFY_TOLERANCE})")
+    parser.add_argument("--format", default="stl", choices=list(MESH_FORMATS), help="output file format (default: stl)")
+    parser.add_argument("--precision", type=float, default=DEFAULT_PRECISION,
+                        help=f"vertex grid for indexed formats, in mesh units (default: {DEFAULT_PRECISION})")
+    parser.add_argument("--batch", action="store_true", help="use batch mode even for a single file")
+    args = parser.parse_args()
+    
+    if not args.batch and len(args.inputs) == 1 and Path(args.inputs[0]).is_file():
+        convert_single(args.inputs[0], args.detector, args.tolerance, args.format, args.precision)
+        return
+    
+    failures = run_batch(args.inputs, args.output_dir, args.manifest, args.workers,
+                         args.tolerance, args.detector, args.format, args.precision)
+    sys.exit(1 if failures else 0)
+
 if __name__ == "__main__":
     main()
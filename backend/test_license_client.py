@@ -0,0 +1,135 @@
+"""LicenseValidator against a local stand-in Keygen server
+
+Run from the backend directory with ``python -m pytest -q``.
+"""
+
+import asyncio
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from license_client import LicenseServiceError, LicenseValidator
+
+ACCOUNT = "test-account"
+
+
+class StandInKeygen(BaseHTTPRequestHandler):
+    """Answers validate-key like Keygen, by license key
+
+    ``VALID`` is valid, ``INVALID`` is not, ``FLAKY-<status>`` fails once
+    with that status and is valid afterwards. Requests for any other
+    account get 401, as Keygen does for a bad token.
+    """
+
+    requests = Counter()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        key = body["meta"]["key"]
+        self.requests[key] += 1
+
+        if self.path != f"/v1/accounts/{ACCOUNT}/licenses/actions/validate-key":
+            self._reply(401, {"errors": [{"title": "Unauthorized", "detail": "must be authenticated"}]})
+        elif key.startswith("FLAKY-") and self.requests[key] == 1:
+            self._reply(int(key.split("-")[1]), {"errors": [{"detail": "try again"}]})
+        elif key == "INVALID":
+            self._reply(200, {"meta": {"valid": False, "detail": "does not exist", "code": "NOT_FOUND"}, "data": None})
+        else:
+            self._reply(200, {"meta": {"valid": True, "code": "VALID"}, "data": {"id": f"lic-{key}"}})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def keygen_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInKeygen)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_counts():
+    StandInKeygen.requests.clear()
+
+
+def check(keygen_url, *keys, account=ACCOUNT, **options):
+    """Validate each key in turn with one validator, returning results or exceptions"""
+    async def run():
+        validator = LicenseValidator(account, "token", base_url=keygen_url, **options)
+        results = []
+        try:
+            for key in keys:
+                try:
+                    results.append(await validator.validate(key))
+                except LicenseServiceError as e:
+                    results.append(e)
+        finally:
+            await validator.aclose()
+        return results
+    return asyncio.run(run())
+
+
+def test_valid_key_is_cached(keygen_url):
+    first, second = check(keygen_url, "VALID", "VALID")
+    assert first == second == {"valid": True, "license_id": "lic-VALID",
+                               "message": "License validated successfully"}
+    assert StandInKeygen.requests["VALID"] == 1
+
+
+def test_invalid_key_is_cached(keygen_url):
+    first, second = check(keygen_url, "INVALID", "INVALID")
+    assert first == second == {"valid": False, "message": "does not exist"}
+    assert StandInKeygen.requests["INVALID"] == 1
+
+
+@pytest.mark.parametrize("status", [500, 503, 429])
+def test_server_errors_are_retried(keygen_url, status):
+    key = f"FLAKY-{status}"
+    failed, retried = check(keygen_url, key, key)
+    assert isinstance(failed, LicenseServiceError)
+    assert str(status) in str(failed)
+    assert retried["valid"] is True
+    assert StandInKeygen.requests[key] == 2
+
+
+def test_misconfigured_account_is_not_an_invalid_key(keygen_url):
+    first, second = check(keygen_url, "VALID", "VALID", account="wrong-account")
+    assert isinstance(first, LicenseServiceError) and isinstance(second, LicenseServiceError)
+    assert "401" in str(first)
+    assert StandInKeygen.requests["VALID"] == 2
+
+
+def test_cache_entries_expire(keygen_url):
+    async def run():
+        validator = LicenseValidator(ACCOUNT, "token", base_url=keygen_url, valid_ttl=0.6, invalid_ttl=0.2)
+        try:
+            for _ in range(2):
+                await validator.validate("VALID")
+                await validator.validate("INVALID")
+                await asyncio.sleep(0.3)
+            # Both entries have now expired
+            await asyncio.sleep(0.4)
+            await validator.validate("VALID")
+            await validator.validate("INVALID")
+        finally:
+            await validator.aclose()
+    asyncio.run(run())
+
+    # The valid result outlived the first pause, the invalid one did not
+    assert StandInKeygen.requests["VALID"] == 2
+    assert StandInKeygen.requests["INVALID"] == 3
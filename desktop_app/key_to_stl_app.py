@@ -7,22 +7,172 @@ from pathlib import Path
 from PIL import Image, ImageTk
 import cv2
 import numpy as np
-from stl import mesh
 import uuid
 import hashlib
+import base64
+import math
+import queue
+import re
+import struct
+import threading
+from collections import OrderedDict
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+except ImportError:
+    # Without it validations cannot be verified offline, so Keygen is always asked
+    Ed25519PublicKey = None
+
+# One binary STL facet: normal, three vertices, attribute byte count
+STL_FACET_DTYPE = np.dtype([
+    ("normal", "<f4", (3,)),
+    ("vertices", "<f4", (3, 3)),
+    ("attr", "<u2"),
+])
+
+def write_binary_stl(output_path, facet_count, chunks, progress=None):
+    """Stream binary STL facets to a file, one (M, 3, 3) triangle chunk at a time
+    
+    facet_count goes in the header, so it must be known before writing.
+    progress, if given, is called with the fraction written after each chunk.
+    """
+    written = 0
+    with open(output_path, "wb") as f:
+        f.write(b"Binary STL written by KeyToSTL".ljust(80, b"\0"))
+        f.write(struct.pack("<I", facet_count))
+        
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            
+            # Vectorized facet normals (zero for degenerate triangles)
+            normals = np.cross(chunk[:, 1] - chunk[:, 0], chunk[:, 2] - chunk[:, 0])
+            length = np.linalg.norm(normals, axis=1, keepdims=True)
+            np.divide(normals, length, out=normals, where=length > 0)
+            
+            records = np.zeros(len(chunk), dtype=STL_FACET_DTYPE)
+            records["normal"] = normals
+            records["vertices"] = chunk
+            f.write(records.tobytes())
+            
+            written += len(chunk)
+            if progress:
+                progress(written / max(facet_count, 1))
+    
+    if written != facet_count:
+        raise ValueError(f"Wrote {written} facets but the STL header declares {facet_count}")
+
+# Working memory per height-grid cell (float32 heights plus resize scratch)
+GRID_BYTES_PER_CELL = 8
+# Working memory per grid cell while building a band of top-surface triangles
+BAND_BYTES_PER_CELL = 512
+
+def heightmap_facet_count(rows, cols):
+    """Triangles in the closed heightmap solid built by heightmap_triangles"""
+    perimeter = 2 * (rows - 1) + 2 * (cols - 1)
+    return 2 * (rows - 1) * (cols - 1) + 3 * perimeter
+
+def heightmap_triangles(heights, step_x, step_y, band_rows):
+    """Yield the triangles of a closed solid over a height grid, in chunks
+    
+    The top surface follows the grid, vertical walls run around its border
+    and a flat base at z=0 is fanned from its centre, so every edge is shared
+    by exactly two triangles. The top surface is built band_rows rows at a
+    time to bound memory.
+    """
+    rows, cols = heights.shape
+    xs = np.arange(cols) * step_x
+    # Image rows run downwards; flip them so the model is not mirrored
+    ys = (rows - 1 - np.arange(rows)) * step_y
+    
+    # Top surface, two triangles per grid cell
+    for r0 in range(0, rows - 1, band_rows):
+        r1 = min(r0 + band_rows, rows - 1)
+        grid = np.empty((r1 - r0 + 1, cols, 3))
+        grid[..., 0] = xs[None, :]
+        grid[..., 1] = ys[r0:r1 + 1, None]
+        grid[..., 2] = heights[r0:r1 + 1]
+        
+        a, b = grid[:-1, :-1], grid[:-1, 1:]
+        c, d = grid[1:, :-1], grid[1:, 1:]
+        cells = np.stack([
+            np.stack([a, c, b], axis=2),
+            np.stack([b, c, d], axis=2),
+        ], axis=2)
+        yield cells.reshape(-1, 3, 3)
+    
+    # Border points, counter-clockwise seen from above
+    r = np.concatenate([
+        np.full(cols - 1, rows - 1), np.arange(rows - 1, 0, -1),
+        np.zeros(cols - 1, dtype=int), np.arange(0, rows - 1),
+    ])
+    c = np.concatenate([
+        np.arange(0, cols - 1), np.full(rows - 1, cols - 1),
+        np.arange(cols - 1, 0, -1), np.zeros(rows - 1, dtype=int),
+    ])
+    top = np.stack([xs[c], ys[r], heights[r, c]], axis=1)
+    bottom = top.copy()
+    bottom[:, 2] = 0
+    top_next = np.roll(top, -1, axis=0)
+    bottom_next = np.roll(bottom, -1, axis=0)
+    
+    # Walls, two triangles per border edge
+    yield np.stack([
+        np.stack([bottom, bottom_next, top_next], axis=1),
+        np.stack([bottom, top_next, top], axis=1),
+    ], axis=1).reshape(-1, 3, 3)
+    
+    # Base, fanned from its centre and facing down
+    center = np.broadcast_to([xs[-1] / 2, ys[0] / 2, 0.0], bottom.shape)
+    yield np.stack([center, bottom_next, bottom], axis=1)
 
 class KeygenLicenseManager:
+    # How long a cached validation lets the app start without reaching Keygen
+    OFFLINE_GRACE_SECONDS = 7 * 24 * 3600
+    # Allowed clock difference between this machine and Keygen
+    CLOCK_SKEW_SECONDS = 300
+    # The account's Ed25519 verify key (hex, from the Keygen dashboard). Set it
+    # here for release builds: the KEYGEN_PUBLIC_KEY environment variable, used
+    # when this is empty, is meant for development, as anyone running the app
+    # can change it. With neither, offline starts are disabled.
+    KEYGEN_PUBLIC_KEY = ""
+    KEYGEN_HOST = "api.keygen.sh"
+    
     def __init__(self):
         self.account_id = "b7ebf59e-18f0-46b0-8a95-e97af6281bdd"
-        self.api_key = os.getenv('KEYGEN_API_KEY', 'YOUR_LICENSE_KEY_HERE')  # Use environment variable        self.base_url = "https://api.keygen.sh/v1/accounts/{}".format(self.account_id)
+        self.api_key = os.getenv('KEYGEN_API_KEY', 'YOUR_LICENSE_KEY_HERE')  # Use environment variable
+        self.base_url = "https://api.keygen.sh/v1/accounts/{}".format(self.account_id)
         self.license_file = Path.home() / ".key_to_stl_license"
+        self.validation_cache_file = Path.home() / ".key_to_stl_license_cache"
+        self.public_key = self.KEYGEN_PUBLIC_KEY or os.getenv("KEYGEN_PUBLIC_KEY", "")
+        if not self.public_key:
+            print("Warning: no Keygen public key configured (KEYGEN_PUBLIC_KEY), "
+                  "so every start waits for online license validation")
+        elif Ed25519PublicKey is None:
+            print("Warning: the cryptography package is missing, "
+                  "so every start waits for online license validation")
         
     def validate_license(self, license_key):
         """Validate a license key with Keygen API"""
+        valid, msg, _ = self.check_license(license_key)
+        return valid, msg
+    
+    def check_license(self, license_key):
+        """Validate with Keygen, returning (valid, message, definitive)
+        
+        definitive is False when Keygen could not be reached, so callers can
+        keep trusting a cached validation while offline.
+        """
         try:
             headers = {
                 "Accept": "application/vnd.api+json",
-                "Content-Type": "application/vnd.api+json"
+                "Content-Type": "application/vnd.api+json",
+                # Signed responses can be checked again later without the network
+                "Keygen-Accept-Signature": 'algorithm="ed25519"',
             }
             
             data = {
@@ -38,15 +188,110 @@ class KeygenLicenseManager:
                 timeout=10
             )
             
+            if response.status_code >= 500:
+                return False, f"License server error ({response.status_code})", False
+            
             if response.status_code == 200:
                 result = response.json()
                 if result.get("meta", {}).get("valid", False):
                     self.save_license(license_key)
-                    return True, "License activated successfully!"
+                    self.save_validation(license_key, response)
+                    return True, "License activated successfully!", True
+            
+            self.clear_validation()
+            return False, "Invalid license key", True
+        except Exception as e:
+            return False, f"License validation error: {str(e)}", False
+    
+    def _validate_target(self, license_key):
+        """HTTP signature request target of the validate call for a key"""
+        return f"post {urlsplit(self.base_url).path}/licenses/{license_key}/actions/validate"
+    
+    def _verified_validation(self, record, license_key):
+        """Check a stored Keygen validate response, returning (validated_at, expiry) or None
+        
+        The response must carry a valid Ed25519 ``Keygen-Signature`` from the
+        account's public key over the request target, host, date and body
+        digest, and its body must report this key valid for this machine.
+        Both times come from the signed data (expiry is None if the license
+        never expires).
+        """
+        if Ed25519PublicKey is None or not self.public_key:
+            return None
+        try:
+            params = dict(re.findall(r'(\w+)="([^"]*)"', record["signature"]))
+            if params.get("algorithm") != "ed25519":
+                return None
+            body = record["body"].encode()
+            digest = "sha-256=" + base64.b64encode(hashlib.sha256(body).digest()).decode()
+            signing_string = "\n".join([
+                f"(request-target): {self._validate_target(license_key)}",
+                f"host: {self.KEYGEN_HOST}",
+                f"date: {record['date']}",
+                f"digest: {digest}",
+            ])
+            public_key = Ed25519PublicKey.from_public_bytes(bytes.fromhex(self.public_key))
+            public_key.verify(base64.b64decode(params["signature"]), signing_string.encode())
             
-            return False, "Invalid license key"
+            result = json.loads(body)
+            meta = result["meta"]
+            attributes = result["data"]["attributes"]
+            if (not meta.get("valid")
+                    or meta.get("scope", {}).get("fingerprint") != self.get_machine_fingerprint()
+                    or license_key not in (result["data"].get("id"), attributes.get("key"))):
+                return None
+            validated_at = parsedate_to_datetime(record["date"]).timestamp()
+            expiry = attributes.get("expiry")
+            if expiry:
+                expiry = datetime.fromisoformat(expiry.replace("Z", "+00:00")).timestamp()
+            return validated_at, expiry or None
+        except (InvalidSignature, ValueError, KeyError, TypeError, AttributeError):
+            return None
+    
+    def save_validation(self, license_key, response):
+        """Store Keygen's signed validate response, if it verifies, for offline starts"""
+        record = {
+            "date": response.headers.get("Date", ""),
+            "signature": response.headers.get("Keygen-Signature", ""),
+            "body": response.text,
+        }
+        if self._verified_validation(record, license_key) is None:
+            self.clear_validation()
+            return
+        try:
+            with open(self.validation_cache_file, 'w') as f:
+                json.dump(record, f)
+        except Exception as e:
+            print(f"Error saving license validation: {e}")
+    
+    def has_cached_validation(self, license_key):
+        """Check for a verified validation of this key within the offline grace period
+        
+        The period runs from the signed response date, and ends early if
+        the license expires.
+        """
+        try:
+            with open(self.validation_cache_file, 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        verified = self._verified_validation(record, license_key) if isinstance(record, dict) else None
+        if verified is None:
+            return False
+        
+        validated_at, expiry = verified
+        now = time.time()
+        return (validated_at - self.CLOCK_SKEW_SECONDS <= now < validated_at + self.OFFLINE_GRACE_SECONDS
+                and (expiry is None or now < expiry))
+    
+    def clear_validation(self):
+        """Forget any cached validation"""
+        try:
+            self.validation_cache_file.unlink()
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            return False, f"License validation error: {str(e)}"
+            print(f"Error clearing license validation: {e}")
     
     def get_machine_fingerprint(self):
         """Generate unique machine fingerprint"""
@@ -71,77 +316,317 @@ class KeygenLicenseManager:
                 print(f"Error loading license: {e}")
         return None
 
+class ConversionCancelled(Exception):
+    """Raised inside a worker task when the user cancels it"""
+
+def _no_progress(fraction, message=""):
+    pass
+
+class ConversionWorker:
+    """Run converter tasks one at a time on a background thread
+    
+    Tasks are called with a ``progress(fraction, message)`` callback, which
+    raises ConversionCancelled once cancel() has been requested. Progress and
+    results are posted to ``events`` for the Tk loop to drain, so widgets are
+    only ever touched from the main thread.
+    """
+    
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.events = queue.Queue()
+        self.current = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, label, fn, *args, on_done=None):
+        """Queue fn(*args, progress=...); on_done(result) runs on the Tk loop"""
+        self.tasks.put((label, fn, args, on_done))
+    
+    def pending(self):
+        """Number of queued tasks, including the running one"""
+        return self.tasks.qsize() + (1 if self.current else 0)
+    
+    def cancel(self, clear_queue=False):
+        """Cancel the running task, and optionally everything queued behind it"""
+        if clear_queue:
+            try:
+                while True:
+                    self.tasks.get_nowait()
+            except queue.Empty:
+                pass
+        if self.current:
+            self._cancel.set()
+    
+    def _run(self):
+        while True:
+            label, fn, args, on_done = self.tasks.get()
+            self._cancel.clear()
+            self.current = label
+            
+            def progress(fraction, message=""):
+                if self._cancel.is_set():
+                    raise ConversionCancelled()
+                self.events.put(("progress", label, fraction, message))
+            
+            try:
+                result = fn(*args, progress=progress)
+                self.events.put(("done", label, on_done, result))
+            except ConversionCancelled:
+                self.events.put(("cancelled", label, None, None))
+            except Exception as e:
+                self.events.put(("done", label, on_done, (False, f"{label} failed: {str(e)}")))
+            finally:
+                self.current = None
+
+def estimate_bitting(contour, num_cuts=20):
+    """Estimate bitting as the top edge of a key contour at num_cuts positions
+    
+    Takes the highest contour point (smallest image y) in each of num_cuts
+    equal-width column bins; bins with no points are interpolated.
+    """
+    points = np.asarray(contour, dtype=np.float64).reshape(-1, 2)
+    x0, x1 = points[:, 0].min(), points[:, 0].max()
+    width = max(x1 - x0, 1.0)
+    
+    bins = np.minimum(((points[:, 0] - x0) * num_cuts / width).astype(int), num_cuts - 1)
+    top = np.full(num_cuts, np.inf)
+    np.minimum.at(top, bins, points[:, 1])
+    
+    xs = x0 + (np.arange(num_cuts) + 0.5) * width / num_cuts
+    found = np.isfinite(top)
+    top[~found] = np.interp(xs[~found], xs[found], top[found])
+    return np.stack([xs, top], axis=1)
+
 class PhotoToSTLConverter:
+    # Results kept per pipeline stage, so sliders can move back and forth
+    STAGE_CACHE_SIZE = 3
+    # Largest side of the coarsest pyramid level used for live previews
+    PREVIEW_MAX_SIZE = 640
+    # Larger photos are decoded at 1/2, 1/4 or 1/8 size to stay under this
+    MAX_DECODE_PIXELS = 12_000_000
+    # OpenCV decode flags per scale-down factor (JPEGs are scaled while decoding)
+    DECODE_FLAGS = {
+        1: cv2.IMREAD_GRAYSCALE,
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+    
     def __init__(self):
         self.image_path = None
         self.processed_image = None
+        # Full-resolution pixels per decoded pixel
+        self.decode_scale = 1
+        
+        # Intermediate results keyed by the image generation and the
+        # parameters that produced them
+        self._stage_cache = {}
+        # Bumped by every load_image, so results for an older image are never reused
+        self.generation = 0
+        # Previews run on the Tk loop and a worker while exports use another
+        self._cache_lock = threading.Lock()
+        self.binary = None
+        self.contours = None
+        self.main_contour = None
+    
+    def _cached(self, stage, generation, key, compute):
+        """Return a stage result, recomputing it only when its inputs changed
         
-    def load_image(self, file_path):
+        Results computed for an image that has since been replaced are
+        returned but not stored.
+        """
+        key = (generation, *key)
+        with self._cache_lock:
+            entries = self._stage_cache.setdefault(stage, OrderedDict())
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+        
+        value = compute()
+        with self._cache_lock:
+            if generation == self.generation:
+                entries = self._stage_cache.setdefault(stage, OrderedDict())
+                entries[key] = value
+                while len(entries) > self.STAGE_CACHE_SIZE:
+                    entries.popitem(last=False)
+        return value
+    
+    def _current_image(self):
+        """The loaded image and its generation, read together"""
+        with self._cache_lock:
+            return self.generation, self.processed_image
+    
+    def load_image(self, file_path, progress=_no_progress):
         """Load and validate image file"""
         try:
+            progress(0.0, "Reading image")
             self.image_path = file_path
-            img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
+            scale = self.decode_scale_for(file_path)
+            img = cv2.imread(file_path, self.DECODE_FLAGS[scale])
             if img is None:
                 raise ValueError("Could not load image")
-            self.processed_image = img
+            # Every cached stage depends on the image
+            with self._cache_lock:
+                self.processed_image = img
+                self.decode_scale = scale
+                self.generation += 1
+                self._stage_cache.clear()
+            self.binary = self.contours = self.main_contour = None
+            progress(1.0, "Image loaded")
+            if scale > 1:
+                return True, f"Image loaded successfully (decoded at 1/{scale} size)"
             return True, "Image loaded successfully"
+        except ConversionCancelled:
+            raise
         except Exception as e:
             return False, f"Error loading image: {str(e)}"
     
-    def process_image(self, threshold=128, depth=5):
+    def decode_scale_for(self, file_path):
+        """Smallest scale-down factor that keeps the decoded image under MAX_DECODE_PIXELS
+        
+        Only the image header is read to get its size.
+        """
+        try:
+            with Image.open(file_path) as header:
+                width, height = header.size
+        except Exception:
+            return 1
+        for scale in (1, 2, 4):
+            if (width // scale) * (height // scale) <= self.MAX_DECODE_PIXELS:
+                return scale
+        return 8
+    
+    def process_image(self, threshold=128, depth=5, progress=_no_progress):
         """Process image to extract key profile"""
         if self.processed_image is None:
             return False, "No image loaded"
         
         try:
-            # Apply threshold
-            _, binary = cv2.threshold(self.processed_image, threshold, 255, cv2.THRESH_BINARY)
-            
-            # Find contours
-            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Threshold and find contours at full resolution
+            progress(0.0, "Finding key contour")
+            self.binary, self.contours, self.main_contour = self._detect(threshold, 0)
             
-            if not contours:
+            if self.main_contour is None:
                 return False, "No key detected in image"
             
-            # Get largest contour (assumed to be the key)
-            main_contour = max(contours, key=cv2.contourArea)
-            
+            progress(1.0, "Key detected")
             return True, "Image processed successfully"
+        except ConversionCancelled:
+            raise
         except Exception as e:
             return False, f"Processing error: {str(e)}"
     
-    def generate_stl(self, output_path, depth=5):
-        """Generate STL file from processed image"""
+    def pyramid(self):
+        """Image pyramid from full resolution (level 0) down to preview size"""
+        return self._pyramid(*self._current_image())
+    
+    def _pyramid(self, generation, image):
+        def build():
+            levels = [image]
+            while max(levels[-1].shape) > self.PREVIEW_MAX_SIZE:
+                levels.append(cv2.pyrDown(levels[-1]))
+            return levels
+        return self._cached("pyramid", generation, (), build)
+    
+    def _detect(self, threshold, level, generation=None, levels=None):
+        """Binary mask, contours and key contour at one pyramid level
+        
+        ``generation`` and ``levels`` pin the image, defaulting to the
+        current one.
+        """
+        if levels is None:
+            generation, image = self._current_image()
+            levels = self._pyramid(generation, image)
+        image = levels[level]
+        binary = self._cached(
+            "binary", generation, (threshold, level),
+            lambda: cv2.threshold(image, threshold, 255, cv2.THRESH_BINARY)[1],
+        )
+        
+        def find_contours():
+            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if not contours:
+                return contours, None
+            # Largest contour is assumed to be the key
+            return contours, max(contours, key=cv2.contourArea)
+        
+        contours, main_contour = self._cached("contours", generation, (threshold, level), find_contours)
+        return binary, contours, main_contour
+    
+    def preview(self, threshold=128, level=None, generation=None):
+        """Detect the key and estimate its bitting on a downscaled pyramid level
+        
+        Defaults to the coarsest level. Returns the contour and bitting
+        points in full-resolution pixel coordinates, or (None, None) when
+        no key is found. With ``generation``, raises ConversionCancelled if
+        that image has since been replaced.
+        """
+        current, image = self._current_image()
+        if generation is not None and generation != current:
+            raise ConversionCancelled()
+        generation = current
+        levels = self._pyramid(generation, image)
+        if level is None:
+            level = len(levels) - 1
+        _, _, main_contour = self._detect(threshold, level, generation, levels)
+        if main_contour is None:
+            return None, None
+        
+        contour = main_contour.reshape(-1, 2) * (image.shape[1] / levels[level].shape[1])
+        return contour, estimate_bitting(contour)
+    
+    def height_grid(self, depth, resolution, memory_budget, base_thickness=1.0):
+        """Downsample the image into a grid of heights
+        
+        Returns the heights and the grid spacing along x and y, in pixels
+        of the original full-size image (as is resolution), so the model
+        size does not depend on decode_scale. The spacing is widened beyond
+        resolution if the grid would not fit in half of memory_budget.
+        """
+        with self._cache_lock:
+            generation, image, scale = self.generation, self.processed_image, self.decode_scale
+        h, w = image.shape
+        step = max(resolution / scale, 1.0, math.sqrt(h * w * GRID_BYTES_PER_CELL / (memory_budget / 2)))
+        cols = max(2, int(round(w / step)))
+        rows = max(2, int(round(h / step)))
+        
+        # Area averaging rather than point sampling, to avoid aliasing
+        small = self._cached(
+            "grid", generation, (cols, rows),
+            lambda: cv2.resize(image, (cols, rows), interpolation=cv2.INTER_AREA),
+        )
+        heights = base_thickness + small.astype(np.float32) * (depth / 255.0)
+        return heights, w * scale / cols, h * scale / rows
+    
+    def generate_stl(self, output_path, depth=5, resolution=4, memory_budget=256 * 1024 ** 2,
+                     base_thickness=1.0, progress=_no_progress):
+        """Generate a watertight heightmap STL from the processed image
+        
+        resolution is the grid spacing in original image pixels.
+        memory_budget (bytes) bounds the working memory: the grid is
+        coarsened if needed and the mesh is written in row bands sized to fit.
+        """
         if self.processed_image is None:
             return False, "No image to convert"
         
         try:
-            h, w = self.processed_image.shape
-            
-            # Create simplified mesh
-            vertices = []
-            faces = []
-            
-            # Sample points from image
-            step = 10
-            for y in range(0, h, step):
-                for x in range(0, w, step):
-                    z = (self.processed_image[y, x] / 255.0) * depth
-                    vertices.append([x, y, z])
-                    vertices.append([x, y, 0])  # Bottom face
+            progress(0.0, "Downsampling image")
+            heights, step_x, step_y = self.height_grid(depth, resolution, memory_budget, base_thickness)
+            rows, cols = heights.shape
             
-            # Create simple face structure
-            vertices = np.array(vertices)
-            num_vertices = len(vertices)
+            # Rows per band so each band of triangles stays within a quarter of the budget
+            band_rows = max(1, (memory_budget // 4) // (cols * BAND_BYTES_PER_CELL))
             
-            # Create a simple mesh
-            stl_mesh = mesh.Mesh(np.zeros(num_vertices // 3, dtype=mesh.Mesh.dtype))
-            
-            for i, vertex in enumerate(vertices[:num_vertices // 3]):
-                stl_mesh.vectors[i] = vertices[i*3:(i+1)*3]
-            
-            stl_mesh.save(output_path)
+            write_binary_stl(
+                output_path,
+                heightmap_facet_count(rows, cols),
+                heightmap_triangles(heights, step_x, step_y, band_rows),
+                progress=lambda f: progress(0.1 + 0.9 * f, "Writing STL"),
+            )
             return True, f"STL file saved to {output_path}"
+        except ConversionCancelled:
+            raise
         except Exception as e:
             return False, f"STL generation error: {str(e)}"
 
@@ -149,24 +634,67 @@ class KeyToSTLApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Key to STL Converter")
-        self.root.geometry("800x600")
+        self.root.geometry("800x680")
         
         self.license_manager = KeygenLicenseManager()
         self.converter = PhotoToSTLConverter()
+        self.screen = None
+        
+        # Interactive actions and batch exports run on separate workers so a
+        # long batch never delays the image the operator is working on
+        self.worker = ConversionWorker()
+        self.batch_worker = ConversionWorker()
+        # Progressive preview refinement, restarted whenever the threshold moves
+        self.preview_worker = ConversionWorker()
+        self.root.after(50, self.poll_workers)
+        
+        # Results from background license checks, polled on the Tk loop
+        self.license_results = queue.Queue()
         
-        # Check for existing license
+        # Check for existing license, trusting a signed local validation so
+        # the main window appears without waiting on the network
         saved_license = self.license_manager.load_license()
-        if saved_license:
-            valid, msg = self.license_manager.validate_license(saved_license)
-            if valid:
-                self.show_main_app()
-            else:
-                self.show_license_screen()
+        if saved_license and self.license_manager.has_cached_validation(saved_license):
+            self.show_main_app()
+            self.revalidate_license(saved_license)
+        elif saved_license:
+            self.show_license_screen()
+            self.license_entry.insert(0, saved_license)
+            self.license_status.config(text="Checking saved license...")
+            self.revalidate_license(saved_license)
         else:
             self.show_license_screen()
     
+    def revalidate_license(self, license_key):
+        """Validate a license with Keygen on a background thread"""
+        def worker():
+            self.license_results.put(self.license_manager.check_license(license_key))
+        
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(100, self.poll_license_result)
+    
+    def poll_license_result(self):
+        """Apply a background license check once it finishes"""
+        try:
+            valid, msg, definitive = self.license_results.get_nowait()
+        except queue.Empty:
+            self.root.after(100, self.poll_license_result)
+            return
+        
+        if valid:
+            if self.screen != "main":
+                self.show_main_app()
+        elif definitive:
+            # Keygen rejected the license: drop back to activation
+            self.show_license_screen()
+            self.license_status.config(text=msg)
+        elif self.screen == "license":
+            # Offline with no usable cached validation
+            self.license_status.config(text=msg)
+    
     def show_license_screen(self):
         """Display license activation screen"""
+        self.screen = "license"
         for widget in self.root.winfo_children():
             widget.destroy()
         
@@ -181,6 +709,9 @@ class KeyToSTLApp:
         
         ttk.Button(frame, text="Activate License", command=self.activate_license).pack(pady=10)
         
+        self.license_status = ttk.Label(frame, text="", font=("Arial", 10))
+        self.license_status.pack()
+        
         ttk.Label(frame, text="Don't have a license?", font=("Arial", 10)).pack(pady=20)
         ttk.Label(frame, text="Visit: https://yourwebsite.com/purchase", font=("Arial", 10)).pack()
     
@@ -200,6 +731,7 @@ class KeyToSTLApp:
     
     def show_main_app(self):
         """Display main application interface"""
+        self.screen = "main"
         for widget in self.root.winfo_children():
             widget.destroy()
         
@@ -211,6 +743,8 @@ class KeyToSTLApp:
         menubar.add_cascade(label="File", menu=file_menu)
         file_menu.add_command(label="Open Image", command=self.load_image)
         file_menu.add_command(label="Export STL", command=self.export_stl)
+        file_menu.add_command(label="Batch Export...", command=self.batch_export)
+        file_menu.add_command(label="Cancel Batch", command=self.cancel_batch)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
         
@@ -232,10 +766,69 @@ class KeyToSTLApp:
         ttk.Button(control_frame, text="Load Image", command=self.load_image).pack(side="left", padx=5)
         ttk.Button(control_frame, text="Process", command=self.process_image).pack(side="left", padx=5)
         ttk.Button(control_frame, text="Export STL", command=self.export_stl).pack(side="left", padx=5)
+        ttk.Button(control_frame, text="Cancel", command=self.worker.cancel).pack(side="left", padx=5)
+        
+        # Threshold with live preview
+        preview_frame = ttk.Frame(main_frame)
+        preview_frame.pack()
+        ttk.Label(preview_frame, text="Threshold").pack(side="left", padx=5)
+        self.threshold_var = tk.DoubleVar(value=128)
+        ttk.Scale(preview_frame, from_=0, to=255, length=300, variable=self.threshold_var,
+                  command=lambda _: self.update_preview()).pack(side="left", padx=5)
+        self.preview_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(preview_frame, text="Live preview", variable=self.preview_var,
+                        command=self.update_preview).pack(side="left", padx=5)
+        
+        # Progress
+        self.progress_bar = ttk.Progressbar(main_frame, length=600, maximum=1.0)
+        self.progress_bar.pack(pady=5)
         
         # Status
         self.status_label = ttk.Label(main_frame, text="Ready", font=("Arial", 10))
-        self.status_label.pack(pady=10)
+        self.status_label.pack(pady=5)
+        self.batch_label = ttk.Label(main_frame, text="", font=("Arial", 10))
+        self.batch_label.pack()
+    
+    def poll_workers(self):
+        """Apply progress and results posted by the background workers"""
+        try:
+            for worker in (self.worker, self.batch_worker, self.preview_worker):
+                while True:
+                    try:
+                        kind, label, arg, result = worker.events.get_nowait()
+                    except queue.Empty:
+                        break
+                    if self.screen == "main":
+                        try:
+                            self.handle_worker_event(worker, kind, label, arg, result)
+                        except Exception as e:
+                            # One bad result must not stop the rest from being shown
+                            print(f"Error handling {label}: {e}")
+            
+            if self.screen == "main":
+                pending = self.batch_worker.pending()
+                self.batch_label.config(text=f"Batch: {pending} file(s) remaining" if pending else "")
+        finally:
+            # Always keep polling, or progress and results would stop for good
+            self.root.after(50, self.poll_workers)
+    
+    def handle_worker_event(self, worker, kind, label, arg, result):
+        """Update the UI for one worker event (runs on the Tk loop)"""
+        if kind == "progress":
+            if worker is self.worker:
+                self.progress_bar.config(value=arg)
+                self.status_label.config(text=f"{label}: {result}" if result else label)
+        elif kind == "cancelled":
+            if worker is self.preview_worker:
+                return
+            if worker is self.worker:
+                self.progress_bar.config(value=0)
+            self.status_label.config(text=f"{label} cancelled")
+        elif kind == "done":
+            if worker is self.worker:
+                self.progress_bar.config(value=0)
+            if arg is not None:
+                arg(result)
     
     def load_image(self):
         """Load image file"""
@@ -245,32 +838,100 @@ class KeyToSTLApp:
         )
         
         if file_path:
-            success, msg = self.converter.load_image(file_path)
-            if success:
-                self.display_image(file_path)
-                self.status_label.config(text=msg)
-            else:
-                messagebox.showerror("Error", msg)
-    
-    def display_image(self, file_path):
-        """Display loaded image on canvas"""
-        try:
-            img = Image.open(file_path)
-            img.thumbnail((600, 400))
-            self.photo = ImageTk.PhotoImage(img)
-            self.canvas.create_image(300, 200, image=self.photo)
-        except Exception as e:
-            print(f"Display error: {e}")
+            # Previews of the old image are no longer wanted
+            self.preview_worker.cancel(clear_queue=True)
+            self.worker.submit("Loading image", self._load_task, file_path, on_done=self._loaded)
     
-    def process_image(self):
-        """Process loaded image"""
-        success, msg = self.converter.process_image()
+    def _load_task(self, file_path, progress):
+        """Decode the image and its canvas thumbnail (worker thread)"""
+        success, msg = self.converter.load_image(file_path, progress=progress)
+        thumbnail = None
+        if success:
+            # Built here so the first preview does not pyrDown the image on the Tk loop
+            self.converter.pyramid()
+            try:
+                thumbnail = Image.open(file_path)
+                thumbnail.thumbnail((600, 400))
+            except Exception as e:
+                print(f"Display error: {e}")
+        return success, msg, thumbnail
+    
+    def _loaded(self, result):
+        success, msg = result[:2]
         if success:
+            if result[2] is not None:
+                self.display_image(result[2])
             self.status_label.config(text=msg)
-            messagebox.showinfo("Success", msg)
+            self.update_preview()
         else:
             messagebox.showerror("Error", msg)
     
+    def display_image(self, img):
+        """Display a loaded image thumbnail on canvas"""
+        self.canvas.delete("all")
+        self.photo = ImageTk.PhotoImage(img)
+        self.canvas.create_image(300, 200, image=self.photo)
+        
+        # Mapping from full-resolution pixels to canvas coordinates
+        self.display_scale = img.width / self.converter.processed_image.shape[1]
+        self.display_offset = (300 - img.width / 2, 200 - img.height / 2)
+    
+    def update_preview(self):
+        """Draw a coarse preview at once, then refine it in the background"""
+        self.preview_worker.cancel(clear_queue=True)
+        self.canvas.delete("preview")
+        if not self.preview_var.get() or not hasattr(self, "display_scale"):
+            return
+        
+        threshold = int(self.threshold_var.get())
+        generation = self.converter.generation
+        contour, bitting = self.converter.preview(threshold)
+        self.draw_preview(generation, threshold, contour, bitting)
+        
+        # Finer pyramid levels, coarsest first; stale levels are dropped on the next change
+        for level in reversed(range(len(self.converter.pyramid()) - 1)):
+            self.preview_worker.submit(
+                "Refining preview", self._preview_task, generation, threshold, level,
+                on_done=self._preview_done,
+            )
+    
+    def _preview_task(self, generation, threshold, level, progress):
+        """Preview one pyramid level of the image it was queued for (worker thread)"""
+        progress(0.0)
+        return (generation, threshold, *self.converter.preview(threshold, level, generation))
+    
+    def _preview_done(self, result):
+        # A failed task reports (False, message) rather than a preview
+        if len(result) == 2:
+            self.status_label.config(text=result[1])
+            return
+        self.draw_preview(*result)
+    
+    def draw_preview(self, generation, threshold, contour, bitting):
+        """Overlay the detected contour and estimated bitting on the canvas"""
+        if (generation != self.converter.generation or threshold != int(self.threshold_var.get())
+                or not self.preview_var.get()):
+            return
+        self.canvas.delete("preview")
+        if contour is None:
+            self.status_label.config(text="Preview: no key detected")
+            return
+        
+        ox, oy = self.display_offset
+        points = contour * self.display_scale + (ox, oy)
+        if len(points) > 1:
+            self.canvas.create_line(*points.ravel().tolist(), *points[0].tolist(),
+                                    fill="#00c000", width=2, tags="preview")
+        for x, y in bitting * self.display_scale + (ox, oy):
+            self.canvas.create_oval(x - 3, y - 3, x + 3, y + 3, outline="red", width=2, tags="preview")
+    
+    def process_image(self):
+        """Process loaded image"""
+        self.worker.submit(
+            "Processing", self.converter.process_image, int(self.threshold_var.get()),
+            on_done=self._show_result,
+        )
+    
     def export_stl(self):
         """Export STL file"""
         file_path = filedialog.asksaveasfilename(
@@ -280,12 +941,54 @@ class KeyToSTLApp:
         )
         
         if file_path:
-            success, msg = self.converter.generate_stl(file_path)
-            if success:
-                self.status_label.config(text=msg)
-                messagebox.showinfo("Success", msg)
-            else:
-                messagebox.showerror("Error", msg)
+            self.worker.submit("Exporting STL", self.converter.generate_stl, file_path, on_done=self._show_result)
+    
+    def _show_result(self, result):
+        success, msg = result
+        if success:
+            self.status_label.config(text=msg)
+            messagebox.showinfo("Success", msg)
+        else:
+            messagebox.showerror("Error", msg)
+    
+    def batch_export(self):
+        """Queue several images for conversion to STL"""
+        file_paths = filedialog.askopenfilenames(
+            title="Select Key Images",
+            filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp")]
+        )
+        if not file_paths:
+            return
+        out_dir = filedialog.askdirectory(title="Select Output Folder")
+        if not out_dir:
+            return
+        
+        for file_path in file_paths:
+            output_path = str(Path(out_dir) / f"{Path(file_path).stem}.stl")
+            self.batch_worker.submit(
+                f"Batch: {Path(file_path).name}", self._batch_task, file_path, output_path,
+                on_done=self._batch_done,
+            )
+    
+    def _batch_task(self, file_path, output_path, progress):
+        """Convert one image with its own converter (worker thread)"""
+        converter = PhotoToSTLConverter()
+        success, msg = converter.load_image(file_path, progress=progress)
+        if success:
+            success, msg = converter.process_image(progress=progress)
+        if not success:
+            return False, f"{Path(file_path).name}: {msg}"
+        return converter.generate_stl(output_path, progress=progress)
+    
+    def _batch_done(self, result):
+        success, msg = result
+        self.status_label.config(text=msg)
+        if not success:
+            print(msg)
+    
+    def cancel_batch(self):
+        """Drop queued batch files and cancel the one in progress"""
+        self.batch_worker.cancel(clear_queue=True)
 
 if __name__ == "__main__":
     root = tk.Tk()
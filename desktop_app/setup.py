@@ -8,14 +8,15 @@ build_exe_options = {
     "packages": [
         "tkinter",
         "requests",
+        "cryptography",
         "PIL",
         "cv2",
         "numpy",
-        "stl",
         "uuid",
         "hashlib",
         "pathlib",
         "json",
+        "struct",
         "os"
     ],
     "include_files": [],